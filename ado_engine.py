@@ -0,0 +1,912 @@
+"""
+ADOpy engine with cached likelihood tables
+==========================================
+
+This module provides `Engine`, a drop-in replacement for `adopy.Engine` used
+by the PsychoPy-based implementations of the delay discounting task
+(`dd_psychopy_ado.py` and `dd_psychopy_non-ado.py`).
+
+At initialization, `adopy.Engine` computes tables over every pair of
+a design and model parameters: the probability of the response, the log
+likelihood of each response, and the entropy of the response. With the
+design grid of the task scripts (1134 designs) and the parameter grid
+(2500 points), it takes around a second, and the tables are computed again
+on every launch even though the grids do not change between participants.
+
+This engine stores the tables in a cache directory under a hash of the task,
+the model and the grids. On later launches with the same task, model and
+grids, the tables are loaded as memory-mapped arrays instead.
+
+The tables can also be kept in reduced precision (`dtype=np.float32`), which
+halves both the memory for the tables and the memory bandwidth to compute
+mutual information on every call of `get_design()`. The posterior itself is
+always kept in double precision. Use `compare_engines` to check that a
+reduced-precision engine chooses the same designs and yields the same
+posterior moments as a double-precision one.
+
+After a number of trials, most points on the parameter grid carry almost no
+posterior mass. With `active_tol`, the engine drops the least probable grid
+points whose total mass is at most `active_tol` when it computes mutual
+information, and renormalises the posterior over the remaining ones (the
+active set). The full posterior is still kept and updated, so the posterior
+moments are not affected.
+
+With `refine=True`, the engine starts with a (coarse) parameter grid and
+re-grids it around the high-density region of the posterior as it
+concentrates: whenever the credible interval of a parameter covers less than
+half of its axis, every axis is replaced by the same number of points over
+its credible interval, and the posterior is carried over onto the new grid
+by interpolation. This gives fine resolution on the parameters without the
+cost of a dense uniform grid. The posterior mass outside the credible
+intervals is discarded for good, since the grid is never widened again.
+
+Mutual information is computed over chunks of the design grid, which can be
+scored on a pool of threads (`n_threads`) since NumPy releases the GIL. The
+chunks do not depend on the number of threads, so the chosen designs are
+exactly the same as with a single thread. To avoid oversubscribing the cores,
+BLAS libraries should run single-threaded (e.g., `OMP_NUM_THREADS=1`).
+
+The posterior is kept as an unnormalised log posterior, so each update only
+adds a row of the log likelihood table. It is normalised lazily, i.e., only
+when the posterior, its moments, or designs are requested, which saves a pass
+over the parameter grid on every update and never underflows. The posterior
+and all of its moments (`post_mean`, `post_cov`, and `post_sd`) are computed
+together in a single pass on the first request after an update, and cached
+until the next update.
+
+A design returned by `get_design()` is a row of the design grid whose `name`
+is its index on the grid, so `update()` finds its row of the log likelihood
+table in constant time instead of searching the grid by value. Designs off
+the grid (e.g., of a staircase) are mapped onto the nearest design on the
+grid as in `adopy.Engine`, or with `off_grid='exact'`, their likelihoods are
+computed on the fly.
+
+To rebuild the posterior from many observations, e.g., of a saved session,
+`update_batch()` gathers their log likelihoods at once and normalises only
+once, optionally returning the posterior moments after each observation.
+
+Prerequisites
+-------------
+* Python 3.5 or above
+* Numpy
+* Pandas
+* SciPy
+* ADOpy 0.3.1
+"""
+
+###############################################################################
+# Load depandancies
+###############################################################################
+
+# To make cache keys and to handle paths for files and directories
+import hashlib
+import shutil
+import tempfile
+import types
+from pathlib import Path
+
+# To compute mutual information on multiple threads
+from concurrent.futures import ThreadPoolExecutor
+
+# Fundamental packages for handling vectors, matrices, and dataframes
+import numpy as np
+import pandas as pd
+from scipy.interpolate import RegularGridInterpolator
+from scipy.special import logsumexp, xlogy
+
+# The base Engine class of the ADOpy package
+import adopy
+from adopy.functions import (
+    expand_multiple_dims,
+    log_lik_bernoulli,
+    make_grid_matrix,
+    make_vector_shape,
+)
+
+__all__ = ['Engine', 'compare_engines']
+
+###############################################################################
+# Global variables
+###############################################################################
+
+# Version of the layout of the cached tables. It is a part of cache keys, so
+# it should be increased whenever the tables or their shapes are changed.
+CACHE_VERSION = 3
+
+# Names of the tables stored in the cache. Each table is saved as a separate
+# `.npy` file so that it can be loaded as a memory-mapped array.
+CACHED_TABLES = ['p_obs', 'log_lik', 'lik_ent', 'marg_log_lik']
+
+# Ways to update the posterior with a design that is not on the design grid
+OFF_GRID = ['nearest', 'exact']
+
+
+###############################################################################
+# Functions for cache keys
+###############################################################################
+
+
+def hash_code(func, h):
+    """Feed the identity and the bytecode of a function into a hash."""
+    h.update('{}.{}'.format(func.__module__, func.__qualname__).encode())
+    hash_code_object(func.__code__, h)
+
+
+def hash_code_object(code, h):
+    """
+    Feed the bytecode, the names, and the constants of a code object into
+    a hash. Nested code objects (e.g., of inner functions) are hashed by
+    their contents, since their `repr` has a memory address that changes in
+    every process.
+    """
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            hash_code_object(const, h)
+        else:
+            h.update(repr(const).encode())
+
+
+def make_cache_key(task, model, grid_design, grid_param, dtype):
+    """
+    Make a key for the tables computed from the given task, model, and grids
+    in the given precision. The grids should be the grid matrices used in an
+    engine, i.e., `engine.grid_design` and `engine.grid_param`.
+    """
+    h = hashlib.sha1()
+
+    # Layout and precision of the tables
+    h.update(str(CACHE_VERSION).encode())
+    h.update(np.dtype(dtype).str.encode())
+
+    # Version of ADOpy, since the tables depend on its likelihood functions
+    h.update(adopy.__version__.encode())
+
+    # Task and model
+    h.update(repr(task).encode())
+    h.update(repr(model).encode())
+    h.update(type(model).__qualname__.encode())
+    hash_code(type(model).compute, h)
+    if model._func is not None:
+        hash_code(model._func, h)
+
+    # Grids for design variables and model parameters
+    for grid in (grid_design, grid_param):
+        h.update(repr(list(grid.columns)).encode())
+        values = np.ascontiguousarray(grid.values, dtype=np.float64)
+        h.update(values.tobytes())
+
+    return h.hexdigest()
+
+
+###############################################################################
+# Functions for grids
+###############################################################################
+
+
+def get_nearest_grid_indices(values, grid, chunk_size=256):
+    """
+    Find the index of the nearest row of `grid` for each row of `values`,
+    both given as 2-D arrays. Rows are processed in chunks to bound the
+    memory for pairwise distances.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    grid = np.asarray(grid, dtype=np.float64)
+
+    idx = np.empty(len(values), dtype=np.intp)
+    for i in range(0, len(values), chunk_size):
+        v = values[i:i + chunk_size]
+        dist = np.square(v[:, None, :] - grid[None, :, :]).sum(-1)
+        idx[i:i + chunk_size] = np.argmin(dist, axis=1)
+    return idx
+
+
+def is_log_axis(axis):
+    """Check if a grid axis is evenly spaced in a log scale."""
+    axis = np.asarray(axis, dtype=np.float64)
+    if len(axis) < 3 or np.any(axis <= 0):
+        return False
+    diff = np.diff(axis)
+    diff_log = np.diff(np.log(axis))
+    return not np.allclose(diff, diff[0]) and np.allclose(diff_log,
+                                                          diff_log[0])
+
+
+def make_axis(lo, hi, num, log=False):
+    """Make a grid axis of `num` points from `lo` to `hi`."""
+    if log:
+        return np.logspace(np.log10(lo), np.log10(hi), num)
+    return np.linspace(lo, hi, num)
+
+
+###############################################################################
+# Engine class
+###############################################################################
+
+
+class Engine(adopy.Engine):
+    """
+    An ADO engine that caches its likelihood tables on disk.
+
+    Parameters
+    ----------
+    task : Task
+        Task object for the engine.
+    model : Model
+        Model object for the engine.
+    grid_design
+        Grids for design variables.
+    grid_param
+        Grids for model parameters.
+    lambda_et : Optional[float]
+        Lambda value for eligibility traces.
+    cache_dir : Optional[Path]
+        Directory to store the tables. If None, the tables are computed at
+        initialization as in `adopy.Engine`.
+    dtype : numpy.dtype
+        Precision of the tables, ``np.float64`` (default) or ``np.float32``.
+    active_tol : Optional[float]
+        Total posterior mass of the grid points to drop from the computation
+        of mutual information, e.g., ``1e-6``. If None, all grid points are
+        used as in `adopy.Engine`.
+    refine : bool
+        Whether to re-grid the parameter grid around the high-density region
+        of the posterior as it concentrates. Each value of `grid_param` should
+        be a 1-D axis, evenly spaced in a linear or a log scale.
+    refine_mass : float
+        Posterior mass of the credible interval for each parameter to re-grid
+        the parameter grid over.
+    n_threads : int
+        Number of threads to compute mutual information.
+    chunk_size : int
+        Number of designs in each chunk to compute mutual information.
+    off_grid : {'nearest', 'exact'}
+        How to update the posterior with a design off the design grid: with
+        the likelihood of the nearest design on the grid (as in
+        `adopy.Engine`), or with its exact likelihood computed on the fly.
+    """
+
+    def __init__(self, task, model, grid_design, grid_param,
+                 lambda_et=None, cache_dir=None, dtype=np.float64,
+                 active_tol=None, refine=False, refine_mass=0.99,
+                 n_threads=1, chunk_size=128, off_grid='nearest'):
+        if refine and any(np.ndim(v) != 1 for v in grid_param.values()):
+            raise ValueError('Refinement needs 1-D axes for grid_param.')
+        if off_grid not in OFF_GRID:
+            raise ValueError(
+                'The argument off_grid should be one of {}.'.format(OFF_GRID))
+
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        self.dtype = np.dtype(dtype)
+        self.active_tol = active_tol
+        self.refine = refine
+        self.refine_mass = refine_mass
+        self.chunk_size = chunk_size
+        self.off_grid = off_grid
+
+        # Thread pool to compute mutual information, shared with any shallow
+        # copies of the engine so that they do not oversubscribe the cores.
+        self.n_threads = n_threads
+        self._executor = None
+        if n_threads > 1:
+            self._executor = ThreadPoolExecutor(max_workers=n_threads)
+
+        # Initial axes of the parameter grid, to restore them on reset.
+        self._grid_param_init = {
+            k: np.asarray(v) for k, v in grid_param.items()
+        }
+        self.grid_param_axes = self._grid_param_init
+
+        super(Engine, self).__init__(task, model, grid_design, grid_param,
+                                     lambda_et=lambda_et)
+
+    @property
+    def log_post(self):
+        """
+        Log posterior distributions of joint parameter space. It is
+        normalised here if it has been updated since the last normalisation.
+        """
+        if not self._log_post_normed:
+            # Make a new array instead of normalising in place, so that
+            # shallow copies of the engine reading it at the same time on
+            # other threads always see a consistent array.
+            lp = self._log_post
+            self._log_post = lp - logsumexp(lp)
+            self._log_post_normed = True
+        return self._log_post
+
+    @log_post.setter
+    def log_post(self, v):
+        self._log_post = np.asarray(v, dtype=np.float64)
+        self._log_post_normed = False
+        self._moments = None
+
+    @property
+    def post(self):
+        """Posterior distributions of joint parameter space"""
+        return self._get_moments()['post']
+
+    @property
+    def post_mean(self):
+        """
+        A vector of estimated means for the posterior distribution.
+        Its length is ``num_params``.
+        """
+        return self._get_moments()['mean']
+
+    @property
+    def post_cov(self):
+        """
+        An estimated covariance matrix for the posterior distribution.
+        Its shape is ``(num_params, num_params)``.
+        """
+        return self._get_moments()['cov']
+
+    @property
+    def post_sd(self):
+        """
+        A vector of estimated standard deviations for the posterior
+        distribution. Its length is ``num_params``.
+        """
+        return self._get_moments()['sd']
+
+    @property
+    def marg_post_axes(self):
+        """
+        Marginal posterior distributions on each axis of the parameter grid,
+        as a dictionary of arrays aligned with `grid_param_axes`. Each value
+        of `grid_param` should be a 1-D axis.
+        """
+        return {
+            name: self._marg_post_axis(i)
+            for i, name in enumerate(self.grid_param_axes)
+        }
+
+    @property
+    def cache_key(self):
+        """Key for the tables of the engine in the cache."""
+        return make_cache_key(self.task, self.model,
+                              self.grid_design, self.grid_param, self.dtype)
+
+    @property
+    def cache_path(self):
+        """Path to the tables of the engine in the cache."""
+        if self.cache_dir is None:
+            return None
+        return self.cache_dir / self.cache_key
+
+    def reset(self):
+        """
+        Reset the engine as in the initial state. The likelihood tables are
+        loaded from the cache if available; otherwise, they are computed and
+        saved into the cache.
+        """
+        self.y_obs = np.array(self.task.responses)
+
+        # Restore the initial parameter grid, which may have been refined.
+        self.grid_param_axes = self._grid_param_init
+        self.grid_param = \
+            make_grid_matrix(self.grid_param_axes)[self.model.params]
+
+        tables = self._load_tables()
+        if tables is None:
+            tables = self._compute_tables()
+            self._save_tables(tables)
+        self._set_tables(tables)
+
+        lp = np.ones(self.grid_param.shape[0])
+        self.log_prior = lp - logsumexp(lp)
+        self.log_post = self.log_prior.copy()
+        self.active_set = np.arange(self.grid_param.shape[0])
+
+        self.ent_marg = None
+        self.ent_cond = None
+        self.mutual_info = None
+
+        self.eligibility_trace = np.zeros(self.grid_design.shape[0])
+
+        self.flag_update_mutual_info = True
+
+    def update(self, design, response):
+        """
+        Update the posterior with the given design and response as in
+        `adopy.Engine`, but without normalising it; it is normalised lazily
+        when it is requested. With `refine`, the parameter grid is refined
+        afterwards if the posterior has concentrated enough.
+
+        A design returned by `get_design()` carries its index on the design
+        grid (as its `name`), so its row of the log likelihood table is found
+        without searching the grid. Other designs, e.g., of a staircase, are
+        handled as given by `off_grid`.
+        """
+        idx_design = self._get_design_index(design)
+        idx_response = int(np.argmin(np.abs(
+            self.y_obs - np.asarray(response, dtype=np.float64))))
+
+        if idx_design is None:
+            # Off-grid design
+            values = self._get_design_values(design)
+            idx_design = int(get_nearest_grid_indices(
+                values[None, :], self.grid_design.values)[0])
+            if self.off_grid == 'exact':
+                ll = self._compute_log_lik_design(values)[:, idx_response]
+            else:
+                ll = self.log_lik[idx_design, :, idx_response]
+        else:
+            ll = self.log_lik[idx_design, :, idx_response]
+
+        self._log_post = self._log_post + ll
+        self._log_post_normed = False
+        self._moments = None
+
+        if self.lambda_et:
+            self.eligibility_trace *= self.lambda_et
+            self.eligibility_trace[idx_design] += 1
+
+        self.flag_update_mutual_info = True
+
+        if self.refine and self._should_refine():
+            self.refine_grid()
+
+    def update_batch(self, designs, responses, return_moments=False):
+        """
+        Update the posterior with many observations at once, e.g., to rebuild
+        the posterior of a saved session. The rows of the log likelihood
+        table for all observations are gathered and summed in a single
+        reduction, and the posterior is normalised only once. With `refine`,
+        the parameter grid is refined only after all the observations.
+
+        Parameters
+        ----------
+        designs : pandas.DataFrame
+            Designs of the observations, with a column for each design
+            variable of the task.
+        responses : array_like
+            Observed responses, one for each design.
+        return_moments : bool, optional
+            If True, return the posterior means and standard deviations after
+            each observation, computed from cumulative sums of the log
+            likelihoods.
+
+        Returns
+        -------
+        moments : pandas.DataFrame or None
+            With `return_moments`, a DataFrame with a row for each observation
+            and columns `mean_<param>` and `sd_<param>` for each parameter;
+            empty if there are no observations.
+        """
+        designs = pd.DataFrame(designs, columns=self.task.designs)
+        columns = ['mean_' + p for p in self.model.params] + \
+            ['sd_' + p for p in self.model.params]
+        if len(designs) == 0:
+            # Nothing to update
+            return pd.DataFrame(columns=columns, dtype=np.float64) \
+                if return_moments else None
+
+        idx_design = get_nearest_grid_indices(designs.values,
+                                              self.grid_design.values)
+        idx_response = get_nearest_grid_indices(
+            np.reshape(responses, (-1, 1)), self.grid_response.values)
+
+        # Log likelihoods of the observations, shape (num_obs, num_grids),
+        # in double precision since they are summed over many observations
+        ll = self.log_lik[idx_design, :, idx_response].astype(np.float64)
+
+        if self.off_grid == 'exact':
+            off = np.any(
+                self.grid_design.values[idx_design] != designs.values, axis=1)
+            for i in np.flatnonzero(off):
+                ll[i] = self._compute_log_lik_design(
+                    designs.values[i])[:, idx_response[i]]
+
+        moments = None
+        if return_moments:
+            # Log posterior after each observation, normalised row-wise
+            lp = np.cumsum(ll, axis=0) + self._log_post
+            lp -= logsumexp(lp, axis=1, keepdims=True)
+            post = np.exp(lp)
+
+            grid = self.grid_param.values
+            mean = np.dot(post, grid)
+            var = np.einsum('np,npk->nk', post,
+                            np.square(grid[None, :, :] - mean[:, None, :]))
+            moments = pd.DataFrame(np.hstack([mean, np.sqrt(var)]),
+                                   columns=columns)
+
+            self._log_post = lp[-1]
+        else:
+            self._log_post = self._log_post + ll.sum(0)
+        self._log_post_normed = return_moments
+        self._moments = None
+
+        if self.lambda_et:
+            # Decay the trace over all observations, with each observation
+            # decayed by the number of observations after it.
+            n = len(idx_design)
+            self.eligibility_trace = \
+                self.eligibility_trace * self.lambda_et ** n
+            np.add.at(self.eligibility_trace, idx_design,
+                      self.lambda_et ** np.arange(n - 1, -1, -1))
+
+        self.flag_update_mutual_info = True
+
+        if self.refine and self._should_refine():
+            self.refine_grid()
+
+        return moments
+
+    def refine_grid(self):
+        """
+        Re-grid every axis of the parameter grid over the credible interval
+        of its parameter with the same number of points, and carry the
+        posterior over onto the new grid by interpolation. The likelihood
+        tables are computed for the new grid, but not saved in the cache.
+
+        The posterior mass outside the credible intervals is discarded for
+        good: the grid only shrinks, and is never widened again until the
+        engine is reset.
+        """
+        axes_old = self.grid_param_axes
+
+        axes_new = {}
+        for i, (name, axis) in enumerate(axes_old.items()):
+            lo, hi = self._credible_interval(i)
+            axis_new = make_axis(axis[lo], axis[hi], len(axis),
+                                 log=is_log_axis(axis))
+
+            # A log axis does not always round-trip its endpoints exactly, so
+            # keep the endpoints of the old axis to stay within its range.
+            axis_new[0], axis_new[-1] = axis[lo], axis[hi]
+            axes_new[name] = axis_new
+
+        # Interpolate the log posterior, in the coordinates where each axis
+        # is evenly spaced so that posterior masses are proportional to
+        # densities on both grids.
+        def coords(axis):
+            return np.log(axis) if is_log_axis(axis) else axis
+
+        interp = RegularGridInterpolator(
+            [coords(axis) for axis in axes_old.values()],
+            self.log_post.reshape([len(axis) for axis in axes_old.values()]))
+        mesh = np.meshgrid(*[
+            np.clip(coords(axis_new), coords(axis_old)[0],
+                    coords(axis_old)[-1])
+            for axis_old, axis_new in zip(axes_old.values(),
+                                          axes_new.values())
+        ], indexing='ij')
+        log_post = interp(np.stack([m.ravel() for m in mesh], axis=-1))
+
+        # Replace the grid and the tables
+        self.grid_param_axes = axes_new
+        self.grid_param = make_grid_matrix(axes_new)[self.model.params]
+        self._set_tables(self._compute_tables())
+
+        lp = np.ones(self.grid_param.shape[0])
+        self.log_prior = lp - logsumexp(lp)
+        self.log_post = log_post
+        self.active_set = np.arange(self.grid_param.shape[0])
+
+        self.flag_update_mutual_info = True
+
+    def _get_design_values(self, design):
+        """Return the values of a design in the order of `task.designs`."""
+        if isinstance(design, (pd.Series, dict)):
+            design = [design[k] for k in self.task.designs]
+        return np.asarray(design, dtype=np.float64).ravel()
+
+    def _get_design_index(self, design):
+        """
+        Return the index of a design on the design grid if it is a design
+        returned by `get_design()` and has not been modified since, or None
+        otherwise.
+        """
+        if not isinstance(design, pd.Series):
+            return None
+
+        idx = design.name
+        if not isinstance(idx, (int, np.integer)) or \
+                not 0 <= idx < len(self.grid_design):
+            return None
+
+        # A design can be modified in place (e.g., by a staircase), so check
+        # that its values still match the row on the grid.
+        row = self.grid_design.values[idx]
+        if not np.array_equal(self._get_design_values(design), row):
+            return None
+        return int(idx)
+
+    def _compute_log_lik_design(self, values):
+        """
+        Compute the log likelihood of each response for a single design over
+        the parameter grid, in the same way as the log likelihood table.
+        Returns an array of shape (parameter, response).
+        """
+        design = pd.DataFrame([values], columns=self.task.designs)
+        shape_design = make_vector_shape(2, 0)
+        shape_param = make_vector_shape(2, 1)
+
+        args = {}
+        args.update({
+            k: v.reshape(shape_design)
+            for k, v in self.task.extract_designs(design).items()
+        })
+        args.update({
+            k: v.reshape(shape_param)
+            for k, v in self.model.extract_params(self.grid_param).items()
+        })
+        p_obs = self.model.compute(**args)
+
+        y = self.y_obs.reshape(make_vector_shape(3, 2))
+        return log_lik_bernoulli(y, np.expand_dims(p_obs, 2))[0]
+
+    def _get_moments(self):
+        """
+        Compute the posterior and all of its moments in a single pass over
+        the parameter grid, and cache them until the next update.
+        """
+        moments = self._moments
+        if moments is None:
+            post = np.exp(self.log_post)
+            grid = self.grid_param.values
+            mean = np.dot(post, grid)
+            d = grid - mean
+            cov = np.dot(d.T, d * post.reshape(-1, 1))
+            moments = {
+                'post': post,
+                'mean': mean,
+                'cov': cov,
+                'sd': np.sqrt(np.diag(cov)),
+            }
+            # Assign the whole dictionary at once, so that other threads
+            # never see a partially computed one.
+            self._moments = moments
+        return moments
+
+    def _marg_post_axis(self, i):
+        """Marginal posterior on the i-th axis of the parameter grid."""
+        shape = [len(axis) for axis in self.grid_param_axes.values()]
+        post = self.post.reshape(shape)
+        return post.sum(axis=tuple(j for j in range(len(shape)) if j != i))
+
+    def _credible_interval(self, i):
+        """
+        Indices of the lower and upper bounds of the credible interval with
+        `refine_mass` on the i-th axis of the parameter grid, padded with one
+        grid point on each side.
+        """
+        cdf = np.cumsum(self._marg_post_axis(i))
+        tail = (1 - self.refine_mass) / 2
+        lo = np.searchsorted(cdf, tail, side='right')
+        hi = np.searchsorted(cdf, 1 - tail, side='left')
+        return max(lo - 1, 0), min(hi + 1, len(cdf) - 1)
+
+    def _should_refine(self):
+        """
+        Check if the credible interval of any parameter covers less than half
+        of its axis.
+        """
+        for i, axis in enumerate(self.grid_param_axes.values()):
+            lo, hi = self._credible_interval(i)
+            if hi - lo + 1 < len(axis) / 2:
+                return True
+        return False
+
+    def _update_mutual_info(self):
+        """
+        Update mutual information using posterior distributions.
+
+        Unlike `adopy.Engine`, the marginal likelihood of each response is
+        computed as a vector-matrix product of the posterior and the
+        likelihood table in the precision of the tables, instead of
+        a log-sum-exp over the whole table. Only the rows of the tables for
+        the active set are used. The design axis is split into chunks of
+        `chunk_size` designs, which are scored on `n_threads` threads.
+        """
+        # If there is no need to update mutual information, it ends.
+        if not self.flag_update_mutual_info:
+            return
+
+        # The table has a column for the likelihood of each response and
+        # a column for the entropy of the response.
+        n_param, n_design, n_col = self.lik_ent.shape
+        n_response = n_col - 1
+        post = self.post
+
+        # Restrict the posterior to the active set. The table is stored with
+        # the parameter axis first, so the rows for the active set are
+        # gathered as contiguous blocks in each chunk.
+        if self.active_tol:
+            self._update_active_set(post)
+            idx = self.active_set
+            post = post[idx] / post[idx].sum()
+        else:
+            idx = slice(None)
+        post = post.astype(self.dtype)
+
+        table = self.lik_ent.reshape(n_param, -1)
+        marg_lik = np.empty((n_design, n_response), dtype=self.dtype)
+        ent_cond = np.empty(n_design, dtype=self.dtype)
+
+        def score(chunk):
+            """Calculate the marginal likelihood (shape (num_design,
+            num_response)) and the conditional entropy for a chunk with
+            a single vector-matrix product."""
+            d = slice(*chunk)
+            dc = slice(chunk[0] * n_col, chunk[1] * n_col)
+            res = np.dot(post, table[idx, dc]).reshape(-1, n_col)
+            marg_lik[d] = res[:, :-1]
+            ent_cond[d] = res[:, -1]
+
+        # The chunks do not depend on the number of threads, so the result is
+        # the same as with a single thread.
+        chunks = [(d, min(d + self.chunk_size, n_design))
+                  for d in range(0, n_design, self.chunk_size)]
+        if self._executor is None:
+            for chunk in chunks:
+                score(chunk)
+        else:
+            list(self._executor.map(score, chunks))
+
+        self.marg_log_lik = np.log(marg_lik)
+
+        # Calculate the marginal entropy. The conditional entropy is already
+        # computed above from the precomputed entropy of each response.
+        self.ent_marg = -xlogy(marg_lik, marg_lik).sum(-1)
+        self.ent_cond = ent_cond
+
+        # Calculate the mutual information.
+        self.mutual_info = self.ent_marg - self.ent_cond
+
+        # Flag that there is no need to update mutual information again.
+        self.flag_update_mutual_info = False
+
+    def _update_active_set(self, post):
+        """
+        Update the active set, i.e., indices of the grid points left after
+        dropping the least probable ones whose total mass is at most
+        `active_tol`.
+        """
+        order = np.argsort(post)
+        n_drop = np.searchsorted(np.cumsum(post[order]), self.active_tol,
+                                 side='right')
+        self.active_set = np.sort(order[n_drop:])
+
+    def _compute_tables(self):
+        """
+        Compute the likelihood tables as in `adopy.Engine`. The tables are
+        computed in double precision and then converted into `dtype`.
+        """
+        self.p_obs = p_obs = self._compute_p_obs()
+        ll = self._compute_log_lik()
+
+        # Marginal log likelihood under the uniform prior
+        lp = np.ones(self.grid_param.shape[0])
+        lp = expand_multiple_dims(lp - logsumexp(lp), 1, 1)
+        mll = logsumexp(ll + lp, axis=1)
+
+        # Likelihood of each response, followed by the entropy of the
+        # response H(Y | d, theta), which does not depend on the posterior.
+        # The parameter axis goes first, i.e., a shape of (parameter, design,
+        # response + 1), so that marginal likelihoods and conditional
+        # entropies are a single vector-matrix product and rows for the
+        # active set are contiguous.
+        lik = np.exp(ll)
+        ent_obs = -np.multiply(lik, ll).sum(-1)
+        lik_ent = np.concatenate([lik, ent_obs[:, :, None]], -1)
+
+        tables = {
+            'p_obs': p_obs,
+            'log_lik': ll,
+            'lik_ent': lik_ent.transpose(1, 0, 2),
+            'marg_log_lik': mll,
+        }
+        return {
+            name: np.ascontiguousarray(table, dtype=self.dtype)
+            for name, table in tables.items()
+        }
+
+    def _set_tables(self, tables):
+        """Set the likelihood tables as attributes of the engine."""
+        self.p_obs = tables['p_obs']
+        self.log_lik = tables['log_lik']
+        self.lik_ent = tables['lik_ent']
+        self.ent_obs = self.lik_ent[:, :, -1].T
+        self.marg_log_lik = tables['marg_log_lik']
+
+    def _load_tables(self):
+        """Load the tables from the cache as memory-mapped arrays."""
+        path = self.cache_path
+        if path is None or not path.is_dir():
+            return None
+
+        try:
+            return {
+                name: np.load(str(path / '{}.npy'.format(name)),
+                              mmap_mode='r')
+                for name in CACHED_TABLES
+            }
+        except (OSError, ValueError):
+            # Broken or incomplete cache; compute the tables again.
+            return None
+
+    def _save_tables(self, tables):
+        """Save the tables into the cache."""
+        path = self.cache_path
+        if path is None:
+            return
+
+        # Write the tables in a temporary directory first and move it into
+        # place, so that other sessions never see a half-written cache.
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path_tmp = Path(tempfile.mkdtemp(dir=str(self.cache_dir)))
+        try:
+            for name in CACHED_TABLES:
+                np.save(str(path_tmp / '{}.npy'.format(name)), tables[name])
+            path_tmp.rename(path)
+        except OSError:
+            # Another session may have saved the same tables already.
+            pass
+        finally:
+            shutil.rmtree(str(path_tmp), ignore_errors=True)
+
+
+###############################################################################
+# Functions for checking engines
+###############################################################################
+
+
+def compare_engines(engine_ref, engine, n_trial=50, seed=None):
+    """
+    Run a simulated session on two engines with the same grids, e.g., a
+    double-precision engine and a reduced-precision one, and compare the
+    designs they choose and their posterior moments.
+
+    A point of the parameter grid is drawn at random for the session. On
+    each trial, both engines are updated with the design chosen by
+    `engine_ref` and a response simulated from the model at that point, so
+    that a single different choice does not make the rest of the session
+    diverge.
+    Both engines are reset before and after the simulation.
+
+    Returns a dictionary with the proportion of trials on which both engines
+    chose the same design (`same_design`), and the largest absolute
+    differences of posterior means (`max_diff_mean`) and standard deviations
+    (`max_diff_sd`) over the session.
+    """
+    rng = np.random.RandomState(seed)
+
+    # Parameter values to simulate responses, drawn uniformly from the grid
+    idx_param = rng.randint(engine_ref.grid_param.shape[0])
+    param = engine_ref.grid_param.iloc[idx_param]
+
+    engine_ref.reset()
+    engine.reset()
+
+    n_same = 0
+    diff_mean = diff_sd = 0.
+    for _ in range(n_trial):
+        design = engine_ref.get_design()
+        n_same += int(design.name == engine.get_design().name)
+
+        args = dict(design.items())
+        args.update(param.items())
+        p_obs = engine_ref.model.compute(**args)
+        response = int(rng.rand() < p_obs)
+
+        engine_ref.update(design, response)
+        engine.update(design, response)
+
+        diff_mean = max(diff_mean, np.max(np.abs(
+            engine_ref.post_mean - engine.post_mean)))
+        diff_sd = max(diff_sd, np.max(np.abs(
+            engine_ref.post_sd - engine.post_sd)))
+
+    engine_ref.reset()
+    engine.reset()
+
+    return {
+        'same_design': n_same / n_trial,
+        'max_diff_mean': diff_mean,
+        'max_diff_sd': diff_sd,
+    }
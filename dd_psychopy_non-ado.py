@@ -49,18 +49,22 @@ Prerequisites
 # To handle paths for files and directories
 from pathlib import Path
 
-# Fundamental packages for handling vectors, matrices, and dataframes
+# Fundamental packages for handling vectors and matrices
 import numpy as np
-import pandas as pd
 
 # An open-source Python package for experiments in neuroscience & psychology
 from psychopy import core, visual, event, data, gui
 
-# Import the basic Engine class of the ADOpy package and pre-implemented
-# Task and Model classes for the delay discounting task.
-from adopy import Engine
+# Import the Engine class that extends the basic Engine class of the ADOpy
+# package with cached likelihood tables (see `ado_engine.py`), and
+# pre-implemented Task and Model classes for the delay discounting task.
+from ado_engine import Engine
 from adopy.tasks.dd import TaskDD, ModelHyp
 
+# A logger to save trial-by-trial data into a file on a writer thread
+# (see `trial_data.py`)
+from trial_data import AsyncTrialLogger
+
 ###############################################################################
 # Global variables
 ###############################################################################
@@ -69,6 +73,12 @@ from adopy.tasks.dd import TaskDD, ModelHyp
 # current working directory.
 PATH_DATA = Path('./data')
 
+# Path to cache the likelihood tables of the ADOpy engine. Since the tables
+# depend only on the task, the model and the grids, they are computed once and
+# reused on later launches. Currently set to the subdirectory `cache` of the
+# current working directory.
+PATH_CACHE = Path('./cache')
+
 # Variables for sizes and position of an option box in which a reward and a
 # delay are shown. BOX_W means the width of a box; BOX_H means the height of
 # a box; DIST_BTWN means the distance between two boxes.
@@ -88,6 +98,47 @@ KEYS_LEFT = ['left', 'z', 'f']
 KEYS_RIGHT = ['right', 'slash', 'j']
 KEYS_CONT = ['space']
 
+# Labels of delays in a weekly unit to show on option boxes. A delay is shown
+# with the label of the nearest delay in the table.
+DELAY_LABELS = {
+    0: 'Now',
+    0.43: 'In 3 days',
+    0.714: 'In 5 days',
+    1: 'In 1 week',
+    2: 'In 2 weeks',
+    3: 'In 3 weeks',
+    4.3: 'In 1 month',
+    6.44: 'In 6 weeks',
+    8.6: 'In 2 months',
+    10.8: 'In 10 weeks',
+    12.9: 'In 3 months',
+    17.2: 'In 4 months',
+    21.5: 'In 5 months',
+    26: 'In 6 months',
+    52: 'In 1 year',
+    104: 'In 2 years',
+    156: 'In 3 years',
+    260: 'In 5 years',
+    520: 'In 10 years'
+}
+
+# Delays in DELAY_LABELS (in ascending order) with their labels, and the
+# midpoints between consecutive delays, to find the nearest delay with
+# `np.searchsorted`.
+DELAY_VALUES = np.array(list(DELAY_LABELS.keys()), dtype=np.float64)
+DELAY_STRS = np.array(list(DELAY_LABELS.values()), dtype=object)
+DELAY_MIDS = (DELAY_VALUES[:-1] + DELAY_VALUES[1:]) / 2
+
+# Whether to record the time of every flip of the window, to save the onset
+# time of the options, the number of frames timed, and the number of dropped
+# frames (longer than 1.2 refreshes) of each trial next to `rt`.
+RECORD_FRAMES = False
+
+# Durability policy to save trial-by-trial data into the disk: 'row' flushes
+# every row to the file, 'fsync' also forces the file to the disk every ten
+# rows, and 'block' forces the file to the disk only at the end of each block.
+DURABILITY = 'row'
+
 # Instruction strings. Each string indicates a script to show for each screen.
 INSTRUCTION = [
     # 0 - intro
@@ -143,33 +194,67 @@ Press <space> to end.
 
 
 def convert_delay_to_str(delay):
-    """Convert a delay value in a weekly unit into a human-readable string."""
-    tbl_conv = {
-        0: 'Now',
-        0.43: 'In 3 days',
-        0.714: 'In 5 days',
-        1: 'In 1 week',
-        2: 'In 2 weeks',
-        3: 'In 3 weeks',
-        4.3: 'In 1 month',
-        6.44: 'In 6 weeks',
-        8.6: 'In 2 months',
-        10.8: 'In 10 weeks',
-        12.9: 'In 3 months',
-        17.2: 'In 4 months',
-        21.5: 'In 5 months',
-        26: 'In 6 months',
-        52: 'In 1 year',
-        104: 'In 2 years',
-        156: 'In 3 years',
-        260: 'In 5 years',
-        520: 'In 10 years'
-    }
-    mv, ms = None, None
-    for (v, s) in tbl_conv.items():
-        if mv is None or np.square(delay - mv) > np.square(delay - v):
-            mv, ms = v, s
-    return ms
+    """
+    Convert a delay value in a weekly unit into a human-readable string, i.e.,
+    the label of the nearest delay in DELAY_LABELS (the smaller delay on a
+    tie). An array or a Series of delays is converted into an array of labels.
+    """
+    # Delays in the table (e.g., all delays of the design grid) are looked up
+    # directly.
+    if np.isscalar(delay) and delay in DELAY_LABELS:
+        return DELAY_LABELS[delay]
+
+    d = np.asarray(delay, dtype=np.float64)
+
+    # The nearest delay is found by the midpoints, then the squared distances
+    # to it and its neighbors are compared to break ties exactly.
+    k = np.searchsorted(DELAY_MIDS, d)[..., None] + np.arange(-1, 2)
+    k = np.clip(k, 0, len(DELAY_VALUES) - 1)
+    with np.errstate(over='ignore', invalid='ignore'):
+        dist = np.square(d[..., None] - DELAY_VALUES[k])
+        idx = np.take_along_axis(k, np.argmin(dist, -1)[..., None], -1)
+        idx = idx[..., 0]
+
+        # If the first neighbor ties with the nearest delay (e.g., when the
+        # distances are rounded for a large delay) or the distances are NaN,
+        # delays further down may tie as well; those delays are compared
+        # with all the delays in the table, taking the first on a tie.
+        tie = (k[..., 0] > 0) & ~(dist[..., 0] > np.min(dist, -1))
+        if np.any(tie):
+            dist_all = np.square(d[tie][:, None] - DELAY_VALUES)
+            idx[tie] = np.argmin(dist_all, -1)
+    return DELAY_STRS[idx]
+
+
+def convert_reward_to_str(reward):
+    """Convert a reward value into a string in dollars."""
+    return '${:,.0f}'.format(reward)
+
+
+def make_label_stims(labels):
+    """
+    Make a text stimulus for each of given labels. Each stimulus keeps its
+    rendered text, so drawing it later does not lay out the text again.
+    """
+    global window
+
+    stims = {}
+    for label in labels:
+        stims[label] = visual.TextStim(window, label, font=TEXT_FONT)
+        stims[label].size = TEXT_SIZE
+    return stims
+
+
+def get_label_stim(label):
+    """
+    Get the text stimulus for a label from `label_stims`, or make one for
+    a label not seen before and keep it there.
+    """
+    global label_stims
+
+    if label not in label_stims:
+        label_stims.update(make_label_stims([label]))
+    return label_stims[label]
 
 
 def show_instruction(inst):
@@ -187,29 +272,44 @@ def show_instruction(inst):
     _ = event.waitKeys(keyList=KEYS_CONT)
 
 
-def show_countdown():
-    """Count three before starting the main task."""
+def record_frames(on):
+    """
+    Start or stop recording the intervals between flips of the window, only
+    if RECORD_FRAMES is set. The first flip after recording starts is not
+    timed, so waits between screens are not counted as dropped frames.
+    """
     global window
 
-    text1 = visual.TextStim(window, text='1', pos=(0., 0.), height=2)
-    text2 = visual.TextStim(window, text='2', pos=(0., 0.), height=2)
-    text3 = visual.TextStim(window, text='3', pos=(0., 0.), height=2)
+    window.recordFrameIntervals = RECORD_FRAMES and on
 
-    text3.draw()
-    window.flip()
-    core.wait(1)
 
-    text2.draw()
-    window.flip()
-    core.wait(1)
+def flip_frames(duration, draw=None):
+    """
+    Show frames for a given duration in seconds, counted in refreshes of the
+    window instead of sleeping. `draw` is called to draw each frame.
+    """
+    global window, frame_rate
 
-    text1.draw()
-    window.flip()
-    core.wait(1)
+    n_frames = max(1, int(round(duration * frame_rate)))
+    for _ in range(n_frames):
+        if draw is not None:
+            draw()
+        window.flip()
 
 
-def draw_option(delay, reward, direction, chosen=False):
-    """Draw an option with given delay and reward value."""
+def show_countdown():
+    """Count three before starting the main task."""
+    global countdown_stims
+
+    for n in [3, 2, 1]:
+        flip_frames(1, countdown_stims[n].draw)
+
+
+def make_option_box(direction):
+    """
+    Make the box of an option on a given side. It is made once for each side
+    and reused by `draw_option`, which only changes its fill color.
+    """
     global window
 
     pos_x_center = direction * DIST_BTWN
@@ -218,36 +318,46 @@ def draw_option(delay, reward, direction, chosen=False):
     pos_y_top = BOX_H / 2
     pos_y_bottom = -BOX_H / 2
 
-    fill_color = 'darkgreen' if chosen else None
+    return visual.ShapeStim(window,
+                            lineWidth=8,
+                            lineColor='white',
+                            fillColor=None,
+                            vertices=((pos_x_left, pos_y_top),
+                                      (pos_x_right, pos_y_top),
+                                      (pos_x_right, pos_y_bottom),
+                                      (pos_x_left, pos_y_bottom)))
+
+
+def draw_option(delay, reward, direction, chosen=False):
+    """Draw an option with given delay and reward value."""
+    global option_boxes
+
+    pos_x_center = direction * DIST_BTWN
 
     # Show the option box
-    box = visual.ShapeStim(window,
-                           lineWidth=8,
-                           lineColor='white',
-                           fillColor=fill_color,
-                           vertices=((pos_x_left, pos_y_top),
-                                     (pos_x_right, pos_y_top),
-                                     (pos_x_right, pos_y_bottom),
-                                     (pos_x_left, pos_y_bottom)))
+    box = option_boxes[direction]
+    box.fillColor = 'darkgreen' if chosen else None
     box.draw()
 
-    # Show the reward
-    text_a = visual.TextStim(window,
-                             '${:,.0f}'.format(reward),
-                             font=TEXT_FONT,
-                             pos=(pos_x_center, 1))
-    text_a.size = TEXT_SIZE
+    # Show the reward and the delay with their prerendered labels, which only
+    # need to be moved to the side of the option.
+    text_a = get_label_stim(convert_reward_to_str(reward))
+    text_a.pos = (pos_x_center, 1)
     text_a.draw()
 
-    # Show the delay
-    text_d = visual.TextStim(window,
-                             convert_delay_to_str(delay),
-                             font=TEXT_FONT,
-                             pos=(pos_x_center, -1))
-    text_d.size = TEXT_SIZE
+    text_d = get_label_stim(convert_delay_to_str(delay))
+    text_d.pos = (pos_x_center, -1)
     text_d.draw()
 
 
+def draw_feedback(design, direction, response):
+    """Draw the options of a design, highlighting the chosen one."""
+    draw_option(design['t_ss'], design['r_ss'], -1 * direction,
+                response == 0)
+    draw_option(design['t_ll'], design['r_ll'], 1 * direction,
+                response == 1)
+
+
 def run_trial(design):
     """Run one trial for the delay discounting task using PsychoPy."""
     # Use the PsychoPy window object defined in a global scope.
@@ -258,10 +368,20 @@ def run_trial(design):
     direction = np.random.randint(0, 2) * 2 - 1  # Return -1 or 1
     is_ll_on_left = int(direction == -1)
 
+    # Count the frames timed and dropped so far, and sync to a refresh with
+    # an empty frame when timing frames, so that the onset frame below is
+    # timed from that refresh.
+    n_timed = len(window.frameIntervals)
+    n_dropped = window.nDroppedFrames
+    if RECORD_FRAMES:
+        record_frames(True)
+        window.flip()
+
     # Draw SS and LL options using the predefined function `draw_option`.
     draw_option(design['t_ss'], design['r_ss'], -1 * direction)
     draw_option(design['t_ll'], design['r_ll'], 1 * direction)
-    window.flip()
+    onset = window.flip()
+    record_frames(False)
 
     # Wait until the participant responds and get the response time.
     timer = core.Clock()
@@ -275,17 +395,25 @@ def run_trial(design):
     response = int((key_left and is_ll_on_left) or
                    (not key_left and not is_ll_on_left))  # LL option
 
-    # Draw two options while highlighting the chosen one.
-    draw_option(design['t_ss'], design['r_ss'], -1 * direction, response == 0)
-    draw_option(design['t_ll'], design['r_ll'], 1 * direction, response == 1)
-    window.flip()
-    core.wait(1)
+    # Show two options for one second while highlighting the chosen one.
+    record_frames(True)
+    flip_frames(1, lambda: draw_feedback(design, direction, response))
 
     # Show an empty screen for one second.
-    window.flip()
-    core.wait(1)
+    flip_frames(1)
+    record_frames(False)
+
+    # Onset time of the options, and the numbers of frames timed and dropped
+    # in the trial, if frames are recorded.
+    timing = {}
+    if RECORD_FRAMES:
+        timing = {
+            'onset': onset,
+            'n_frames': len(window.frameIntervals) - n_timed,
+            'n_dropped': window.nDroppedFrames - n_dropped,
+        }
 
-    return is_ll_on_left, key_left, response, rt
+    return is_ll_on_left, key_left, response, rt, timing
 
 
 ###############################################################################
@@ -320,9 +448,25 @@ path_output = PATH_DATA / filename_output
 window = visual.Window(size=[1440, 900], units='deg', monitor='testMonitor',
                        color='#333', screen=0, allowGUI=True, fullscr=False)
 
-# Assign the escape key for a shutdown of the task
+# Assign the escape key for a shutdown of the task. The trial data waiting for
+# the writer thread are still saved when the task quits.
 event.globalKeys.add(key='escape', func=core.quit, name='shutdown')
 
+# Measure the refresh rate of the display to count durations in frames, or
+# assume 60 Hz if it cannot be measured.
+frame_rate = window.getActualFrameRate() or 60.0
+window.refreshThreshold = 1.2 / frame_rate
+
+# Make the numbers for the countdown once to reuse them on every countdown.
+countdown_stims = {
+    n: visual.TextStim(window, text=str(n), pos=(0., 0.), height=2)
+    for n in [1, 2, 3]
+}
+
+# Make the option boxes once for each side (-1: left, 1: right) to reuse them
+# on every trial.
+option_boxes = {d: make_option_box(d) for d in [-1, 1]}
+
 ###############################################################################
 # ADOpy Initialization (only for parameter estimation)
 ###############################################################################
@@ -355,7 +499,19 @@ grid_param = {
 }
 
 # Initialize the ADOpy engine with the task, model, and grids defined above.
-engine = Engine(task, model, grid_design, grid_param)
+# The likelihood tables are loaded from PATH_CACHE if they were computed on
+# an earlier launch.
+# Designs of the staircase method can fall off the design grid, so update the
+# posterior with their exact likelihoods.
+engine = Engine(task, model, grid_design, grid_param, cache_dir=PATH_CACHE,
+                off_grid='exact')
+
+# Prerender the labels of all rewards and delays that can be shown with the
+# design grid, so that showing options does not lay out any text.
+label_stims = make_label_stims(
+    [convert_reward_to_str(r)
+     for r in np.concatenate([grid_design['r_ss'], grid_design['r_ll']])] +
+    list(DELAY_LABELS.values()))
 
 ###############################################################################
 # Prepare designs for the staircase method
@@ -374,15 +530,21 @@ delta = 200
 # Main codes
 ###############################################################################
 
-# Make an empty DataFrame `df_data` to store trial-by-trial information,
-# with given column labels as the `columns` object.
+# Open a logger to save trial-by-trial information into the output file,
+# with given column labels as the `columns` object. The header is written
+# once, and then a row is appended to the file on every trial by a writer
+# thread, so that writing does not delay the next trial.
 columns = [
     'block', 'trial',
     't_ss', 't_ll', 'r_ss', 'r_ll',
     'is_ll_on_left', 'key_left', 'response', 'rt',
-    'mean_k', 'mean_tau'
+    'mean_k', 'mean_tau', 'sd_k', 'sd_tau'
 ]
-df_data = pd.DataFrame(None, columns=columns)
+if RECORD_FRAMES:
+    # Add the columns of frame timing next to `rt`.
+    i = columns.index('rt') + 1
+    columns[i:i] = ['onset', 'n_frames', 'n_dropped']
+logger = AsyncTrialLogger(path_output, columns, durability=DURABILITY)
 
 # -----------------------------------------------------------------------------
 # Practice block (using randomly chosen designs)
@@ -402,10 +564,10 @@ for trial in range(n_prac):
     design = engine.get_design('random')
 
     # Run a trial using the design
-    is_ll_on_left, key_left, response, rt = run_trial(design)
+    is_ll_on_left, key_left, response, rt, timing = run_trial(design)
 
-    # Append the current trial into the DataFrame
-    df_data = df_data.append(pd.Series({
+    # Append the current trial into the output file
+    logger.write({
         'block': 'prac',
         'trial': trial + 1,
         't_ss': design['t_ss'],
@@ -416,10 +578,11 @@ for trial in range(n_prac):
         'key_left': key_left,
         'response': response,
         'rt': rt,
-    }), ignore_index=True)
+        **timing,
+    })
 
-    # Save the current data into a file
-    df_data.to_csv(path_output, index=False)
+# Mark the end of the practice block
+logger.end_block()
 
 # -----------------------------------------------------------------------------
 # Main block (using staircase designs)
@@ -454,13 +617,13 @@ for trial in range(n_trial):
         delta = delta / 2
 
     # Run a trial using the design
-    is_ll_on_left, key_left, response, rt = run_trial(design)
+    is_ll_on_left, key_left, response, rt, timing = run_trial(design)
 
     # Update the engine just for parameter estimation.
     engine.update(design, response)
 
-    # Append the current trial into the DataFrame
-    df_data = df_data.append(pd.Series({
+    # Append the current trial into the output file
+    logger.write({
         'block': 'main',
         'trial': trial + 1,
         't_ss': design['t_ss'],
@@ -471,17 +634,23 @@ for trial in range(n_trial):
         'key_left': key_left,
         'response': response,
         'rt': rt,
+        **timing,
         'mean_k': engine.post_mean[0],
         'mean_tau': engine.post_mean[1],
         'sd_k': engine.post_sd[0],
         'sd_tau': engine.post_sd[1],
-    }), ignore_index=True)
+    })
 
-    # Save the current data into a file
-    df_data.to_csv(path_output, index=False)
+# Mark the end of the main block
+logger.end_block()
 
 # Show the last instruction screen (4)
 show_instruction(INSTRUCTION[4])
 
+# Wait until all the trial data are saved and close the output file, and keep
+# the data of the whole session as a DataFrame
+logger.close()
+df_data = logger.to_dataframe()
+
 # Close the PsychoPy window
 window.close()
@@ -0,0 +1,216 @@
+"""
+Offline refit of stored sessions
+================================
+
+This script re-estimates the model parameters of every stored session of the
+delay discounting task, e.g., after a change of the parameter grid or of the
+model. Each session is refitted by updating the posterior with all the trials
+of its main block at once (`Engine.update_batch`), starting from a uniform
+prior over the new grid.
+
+Sessions are fanned out over a pool of processes. The likelihood tables are
+computed once by the main process and saved into the cache directory of the
+engine (see `ado_engine.py`); each worker loads them as memory-mapped arrays,
+so all the workers share a single copy of the read-only tables through the
+page cache of the operating system. The estimates of each session are
+written into the output table as soon as the session is refitted. Sessions
+that cannot be refitted, e.g., files truncated by a crash, are reported and
+skipped.
+
+Usage
+-----
+To refit all sessions in `./data` with a wider grid on `tau`::
+
+    python refit.py --grid k=1e-5:1:50:log --grid tau=0:10:100
+
+A grid is given as `name=low:high:num`, with a trailing `:log` for a grid
+evenly spaced in a log scale. Parameters without a grid use the grids of the
+task scripts, if any. See `python refit.py --help` for other options.
+
+Prerequisites
+-------------
+* Python 3.7 or above
+* Numpy
+* Pandas
+* ADOpy 0.3.1
+"""
+
+###############################################################################
+# Load depandancies
+###############################################################################
+
+# To handle paths for files and directories, and command-line arguments
+import argparse
+import os
+from pathlib import Path
+
+# To refit sessions on a pool of processes
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Run BLAS libraries on a single thread in each worker, since sessions are
+# already refitted in parallel. These variables should be set before NumPy is
+# loaded.
+for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+            'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']:
+    os.environ.setdefault(var, '1')
+
+# Fundamental packages for handling vectors and matrices
+import numpy as np  # noqa: E402
+
+# The engine with cached likelihood tables, and the task and models for the
+# delay discounting task
+import adopy.tasks.dd  # noqa: E402
+from ado_engine import Engine, make_axis  # noqa: E402
+from adopy.tasks.dd import TaskDD  # noqa: E402
+
+# To read session files and to write the output table
+from study_index import is_session_file  # noqa: E402
+from trial_data import TrialLogger, read_session  # noqa: E402
+
+###############################################################################
+# Global variables
+###############################################################################
+
+# Path to the stored sessions, and to cache the likelihood tables
+PATH_DATA = Path('./data')
+PATH_CACHE = Path('./cache')
+
+# Grid for designs, same as in the task scripts
+GRID_DESIGN = {
+    't_ss': [0],
+    't_ll': [0.43, 0.714, 1, 2, 3, 4.3, 6.44, 8.6, 10.8, 12.9,
+             17.2, 21.5, 26, 52, 104, 156, 260, 520],
+    'r_ss': np.arange(12.5, 800, 12.5),  # [12.5, 25, ..., 787.5]
+    'r_ll': [800]
+}
+
+# Default grids for model parameters, same as in the task scripts
+GRID_PARAM = {
+    'k': np.logspace(-5, 0, 50),
+    'tau': np.linspace(0, 5, 50)
+}
+
+# Engine of each worker process, made by `init_worker`
+engine = None
+
+
+###############################################################################
+# Functions for refitting sessions
+###############################################################################
+
+
+def make_engine(model_name, grid_param, cache_dir):
+    """Make an engine for the delay discounting task with the given model."""
+    model = getattr(adopy.tasks.dd, model_name)()
+    return Engine(TaskDD(), model, GRID_DESIGN, grid_param,
+                  cache_dir=cache_dir, off_grid='exact')
+
+
+def init_worker(model_name, grid_param, cache_dir):
+    """
+    Make the engine of a worker process. The likelihood tables are loaded
+    from the cache as memory-mapped arrays, shared with the other workers.
+    """
+    global engine
+    engine = make_engine(model_name, grid_param, cache_dir)
+
+
+def refit_session(path):
+    """
+    Refit a session with the engine of the worker, from a uniform prior.
+    Returns a row of the output table as a dictionary.
+    """
+    df, _ = read_session(path)
+    if 'block' in df:
+        df = df[df['block'] == 'main']
+    df = df.dropna(subset=['response'])
+
+    engine.log_post = engine.log_prior.copy()
+    engine.update_batch(df[engine.task.designs], df['response'].values)
+
+    row = {'session': Path(path).stem, 'n_trials': len(df)}
+    for param, mean, sd in zip(engine.model.params, engine.post_mean,
+                               engine.post_sd):
+        row['mean_' + param] = mean
+        row['sd_' + param] = sd
+    return row
+
+
+def refit_sessions(paths, model_name, grid_param, path_output, cache_dir,
+                   processes=None):
+    """
+    Refit the sessions in `paths` on a pool of processes, writing a row of
+    estimates into the output table as soon as each session is refitted.
+    A session that cannot be refitted (e.g., a file truncated by a crash) is
+    reported and skipped. Returns the paths of the skipped sessions.
+    """
+    model = getattr(adopy.tasks.dd, model_name)()
+    columns = ['session', 'n_trials'] + \
+        ['mean_' + p for p in model.params] + \
+        ['sd_' + p for p in model.params]
+
+    skipped = []
+    with TrialLogger(path_output, columns) as logger, \
+            ProcessPoolExecutor(max_workers=processes,
+                                initializer=init_worker,
+                                initargs=(model_name, grid_param,
+                                          cache_dir)) as executor:
+        futures = {executor.submit(refit_session, p): p for p in paths}
+        for i, future in enumerate(as_completed(futures)):
+            path = futures[future]
+            try:
+                row = future.result()
+            except Exception as e:
+                skipped.append(path)
+                print('[{}/{}] {} skipped: {}: {}'.format(
+                    i + 1, len(paths), path, type(e).__name__, e))
+                continue
+            logger.write(row)
+            print('[{}/{}] {}'.format(i + 1, len(paths), path))
+    return skipped
+
+
+def parse_grid(spec):
+    """Parse a grid given as `name=low:high:num[:log]`."""
+    name, axis = spec.split('=')
+    values = axis.split(':')
+    log = len(values) == 4 and values[3] == 'log'
+    return name, make_axis(float(values[0]), float(values[1]),
+                           int(values[2]), log=log)
+
+
+###############################################################################
+# Main
+###############################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Refit stored sessions.')
+    parser.add_argument('--data', type=Path, default=PATH_DATA,
+                        help='Directory of the stored sessions.')
+    parser.add_argument('--pattern', default='ddt_*',
+                        help='Glob pattern of the session files.')
+    parser.add_argument('--model', default='ModelHyp',
+                        help='Name of a model in adopy.tasks.dd.')
+    parser.add_argument('--grid', action='append', default=[],
+                        help='Grid of a parameter: name=low:high:num[:log].')
+    parser.add_argument('--output', type=Path, default=Path('refit.csv'),
+                        help='Path to the output table.')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='Number of worker processes.')
+    args = parser.parse_args()
+
+    paths = sorted(str(p) for p in args.data.glob(args.pattern)
+                   if is_session_file(p))
+
+    # Compute the likelihood tables once and save them into the cache, so
+    # that the workers only load them.
+    grid_param = dict(GRID_PARAM, **dict(parse_grid(g) for g in args.grid))
+    model = getattr(adopy.tasks.dd, args.model)()
+    missing = [p for p in model.params if p not in grid_param]
+    if missing:
+        parser.error('No grid for {} of {}.'.format(missing, args.model))
+    grid_param = {p: grid_param[p] for p in model.params}
+    engine = make_engine(args.model, grid_param, PATH_CACHE)
+
+    refit_sessions(paths, args.model, grid_param, args.output, PATH_CACHE,
+                   processes=args.processes)
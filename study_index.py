@@ -0,0 +1,276 @@
+"""
+Index of the sessions of a study
+================================
+
+This module provides `StudyIndex`, which consolidates the output files of
+the task scripts (`dd_psychopy_ado.py` and `dd_psychopy_non-ado.py`) in
+a data directory into a single columnar file, so that analyses do not need
+to find and parse every session file again.
+
+The index keeps a table of sessions, with the path, the modification time
+and the size of each session file, the date of the session (from the name of
+the file), the number of trials, and the last posterior estimates in the main
+block. The trials of all sessions are kept in a single table, with
+a `session_id` column to look up their sessions.
+
+On `update()`, only the session files that are new or whose modification
+time or size has changed are read; trials of removed files are dropped. The
+index is saved as an uncompressed `.npz` file only if anything has changed,
+so reopening the index of a study takes a single read of the file and a
+`stat` of each session file.
+
+Usage
+-----
+To update the index of the data directory and summarise the sessions::
+
+    python study_index.py ./data
+
+Prerequisites
+-------------
+* Python 3.5 or above
+* Numpy
+* Pandas
+"""
+
+###############################################################################
+# Load depandancies
+###############################################################################
+
+# To handle paths for files and directories
+import os
+import sys
+from datetime import datetime
+from pathlib import Path
+
+# Fundamental packages for handling vectors, matrices, and dataframes
+import numpy as np
+import pandas as pd
+
+# To read session files
+from trial_data import read_session
+
+__all__ = ['StudyIndex', 'is_session_file']
+
+###############################################################################
+# Global variables
+###############################################################################
+
+# Suffixes of session files saved by the trial loggers
+SESSION_SUFFIXES = ['.csv', '.npz', '.parquet']
+
+# Endings of the names of files saved along with a session, e.g., the
+# checkpoints and the history of the posterior (`ddt_*_post.npy` and
+# `ddt_*_history.npz`), which are not session files
+SIDE_FILE_ENDINGS = ['_post', '_history']
+
+# Format of the date in the names of session files, e.g., `ddt_201907241300`
+DATE_FORMAT = '%Y%m%d%H%M'
+
+# Columns of the last posterior estimates to keep for each session
+ESTIMATES = ['mean_k', 'mean_tau', 'sd_k', 'sd_tau']
+
+# Columns of the table of sessions
+SESSION_COLUMNS = [
+    'session_id', 'session', 'path', 'mtime', 'size', 'date',
+    'n_trials', 'n_main'
+] + ESTIMATES
+
+
+###############################################################################
+# Functions for session files
+###############################################################################
+
+
+def is_session_file(path):
+    """Check if a file is a session file saved by the trial loggers."""
+    path = Path(path)
+    return path.suffix in SESSION_SUFFIXES and \
+        not any(path.stem.endswith(e) for e in SIDE_FILE_ENDINGS)
+
+
+###############################################################################
+# Study index
+###############################################################################
+
+
+class StudyIndex(object):
+    """
+    An index of the sessions in a data directory, with their trials
+    consolidated into a single columnar file.
+
+    Parameters
+    ----------
+    path_data : Path
+        Path to the data directory with session files.
+    path_index : Path, optional
+        Path to the index file. Defaults to `study.npz` in `path_data`.
+    pattern : str, optional
+        Glob pattern of the names of session files.
+    """
+
+    def __init__(self, path_data, path_index=None, pattern='ddt_*'):
+        self.path_data = Path(path_data)
+        self.path_index = Path(path_index) if path_index is not None \
+            else self.path_data / 'study.npz'
+        self.pattern = pattern
+
+        self.sessions = pd.DataFrame(columns=SESSION_COLUMNS)
+        self.trials = pd.DataFrame({'session_id': np.empty(0, np.int64)})
+        if self.path_index.exists():
+            self._load()
+
+    def update(self):
+        """
+        Ingest new and modified session files, and drop sessions whose files
+        were removed. Returns the number of sessions ingested.
+        """
+        files = self._find_files()
+
+        known = {
+            path: (mtime, size) for path, mtime, size in zip(
+                self.sessions['path'], self.sessions['mtime'],
+                self.sessions['size'])
+        }
+        changed = [path for path, stat in files.items()
+                   if known.get(path) != stat]
+        stale = [path for path in known
+                 if path not in files or path in changed]
+        if not changed and not stale:
+            return 0
+
+        # Drop sessions of removed or modified files.
+        is_stale = self.sessions['path'].isin(stale)
+        ids_stale = self.sessions.loc[is_stale, 'session_id']
+        trials = [self.trials[~self.trials['session_id'].isin(ids_stale)]]
+        rows = []
+
+        next_id = int(self.sessions['session_id'].max()) + 1 \
+            if len(self.sessions) > 0 else 0
+        for i, path in enumerate(sorted(changed)):
+            df, _ = read_session(self.path_data / path)
+            df.insert(0, 'session_id', next_id + i)
+            mtime, size = files[path]
+            rows.append(self._summarise(next_id + i, path, mtime, size, df))
+            trials.append(df)
+
+        sessions = [self.sessions[~is_stale],
+                    pd.DataFrame(rows, columns=SESSION_COLUMNS)]
+        self.sessions = pd.concat(sessions, ignore_index=True).infer_objects()
+        self.trials = pd.concat(trials, ignore_index=True,
+                                sort=False).infer_objects()
+        self._save()
+        return len(changed)
+
+    def select_sessions(self, start=None, end=None, **ranges):
+        """
+        Return the sessions within the given dates, and whose columns given
+        as keyword arguments (e.g., `mean_k=(0.001, 0.01)`) are within the
+        given `(low, high)` ranges, inclusive. Either bound can be None.
+        """
+        mask = np.ones(len(self.sessions), dtype=bool)
+        dates = self.sessions['date']
+        if start is not None:
+            mask &= (dates >= pd.Timestamp(start)).to_numpy()
+        if end is not None:
+            mask &= (dates <= pd.Timestamp(end)).to_numpy()
+
+        for col, (low, high) in ranges.items():
+            values = self.sessions[col]
+            if low is not None:
+                mask &= (values >= low).to_numpy()
+            if high is not None:
+                mask &= (values <= high).to_numpy()
+        return self.sessions[mask]
+
+    def get_trials(self, sessions=None, block=None):
+        """
+        Return the trials of the given sessions (a DataFrame from
+        `select_sessions`, or a list of session IDs), or of all sessions.
+        With `block`, return only the trials of the block.
+        """
+        mask = np.ones(len(self.trials), dtype=bool)
+        if sessions is not None:
+            if isinstance(sessions, pd.DataFrame):
+                sessions = sessions['session_id']
+            mask &= self.trials['session_id'].isin(sessions).to_numpy()
+        if block is not None:
+            mask &= (self.trials['block'] == block).to_numpy()
+        return self.trials[mask]
+
+    def _find_files(self):
+        """
+        Return the modification time (in ns) and the size of each session
+        file, by its path relative to the data directory.
+        """
+        files = {}
+        for path in self.path_data.glob(self.pattern):
+            if not is_session_file(path):
+                continue
+            stat = path.stat()
+            files[path.name] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+    def _summarise(self, session_id, path, mtime, size, df):
+        """Return the metadata of a session as a dictionary."""
+        name = Path(path).stem
+        try:
+            date = datetime.strptime(name.split('_')[-1], DATE_FORMAT)
+        except ValueError:
+            date = pd.NaT
+
+        main = df[df['block'] == 'main'] if 'block' in df else df
+        row = {
+            'session_id': session_id,
+            'session': name,
+            'path': path,
+            'mtime': mtime,
+            'size': size,
+            'date': date,
+            'n_trials': len(df),
+            'n_main': len(main),
+        }
+        for col in ESTIMATES:
+            row[col] = main[col].iloc[-1] \
+                if col in main and len(main) > 0 else np.nan
+        return row
+
+    def _save(self):
+        """Save the index into a file, replacing it at once."""
+        arrays = {}
+        for prefix, df in [('s', self.sessions), ('t', self.trials)]:
+            arrays[prefix + '/_columns'] = np.array(df.columns, dtype=str)
+            for col in df.columns:
+                values = df[col].to_numpy()
+                if values.dtype == object:
+                    values = np.array(['' if pd.isnull(v) else str(v)
+                                       for v in values], dtype=str)
+                arrays[prefix + '/' + col] = values
+
+        path_tmp = self.path_index.with_name(self.path_index.name + '.tmp')
+        with path_tmp.open('wb') as f:
+            np.savez(f, **arrays)
+        os.replace(str(path_tmp), str(self.path_index))
+
+    def _load(self):
+        """Load the index from the file."""
+        with np.load(str(self.path_index)) as f:
+            tables = []
+            for prefix in ['s', 't']:
+                columns = list(f[prefix + '/_columns'])
+                tables.append(pd.DataFrame(
+                    {col: f[prefix + '/' + col] for col in columns},
+                    columns=columns))
+        self.sessions, self.trials = tables
+
+
+###############################################################################
+# Command-line interface
+###############################################################################
+
+if __name__ == '__main__':
+    index = StudyIndex(sys.argv[1] if len(sys.argv) > 1 else './data')
+    n_new = index.update()
+    print('Ingested {} session(s); {} session(s) and {} trial(s) in total.'
+          .format(n_new, len(index.sessions), len(index.trials)))
+    print(index.sessions[['session', 'date', 'n_main'] + ESTIMATES]
+          .to_string(index=False))
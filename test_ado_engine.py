@@ -0,0 +1,276 @@
+"""Tests for `ado_engine.py`."""
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import adopy
+from adopy.tasks.dd import TaskDD, ModelHyp
+
+from ado_engine import Engine, compare_engines
+
+# Smaller grids than in the task scripts, to keep the tests fast
+GRID_DESIGN = {
+    't_ss': [0],
+    't_ll': [0.43, 1, 4.3, 12.9, 26, 52, 156, 520],
+    'r_ss': np.arange(50, 800, 50),
+    'r_ll': [800]
+}
+GRID_PARAM = {
+    'k': np.logspace(-5, 0, 20),
+    'tau': np.linspace(0, 5, 10)
+}
+
+
+# Grids of the task scripts, to compare the designs of engines. On coarse
+# grids, many designs are tied in mutual information.
+GRID_DESIGN_TASK = {
+    't_ss': [0],
+    't_ll': [0.43, 0.714, 1, 2, 3, 4.3, 6.44, 8.6, 10.8, 12.9,
+             17.2, 21.5, 26, 52, 104, 156, 260, 520],
+    'r_ss': np.arange(12.5, 800, 12.5),
+    'r_ll': [800]
+}
+GRID_PARAM_TASK = {
+    'k': np.logspace(-5, 0, 50),
+    'tau': np.linspace(0, 5, 50)
+}
+
+
+@pytest.fixture(scope='module')
+def cache_dir(tmp_path_factory):
+    return tmp_path_factory.mktemp('cache')
+
+
+def make_engine(tmp_path, **kwargs):
+    return Engine(TaskDD(), ModelHyp(), GRID_DESIGN, GRID_PARAM,
+                  cache_dir=tmp_path, **kwargs)
+
+
+def make_task_engine(cache_dir, **kwargs):
+    return Engine(TaskDD(), ModelHyp(), GRID_DESIGN_TASK, GRID_PARAM_TASK,
+                  cache_dir=cache_dir, **kwargs)
+
+
+def simulate(engine, n_trial, seed=0, k=0.01, tau=1.):
+    """Return designs (as DataFrame) and responses of a simulated session."""
+    rng = np.random.RandomState(seed)
+    idx = rng.randint(len(engine.grid_design), size=n_trial)
+    designs = engine.grid_design.iloc[idx].reset_index(drop=True)
+    p_obs = engine.model.compute(k=k, tau=tau, **{
+        col: designs[col].values for col in designs.columns})
+    responses = (rng.rand(n_trial) < p_obs).astype(int)
+    return designs, responses
+
+
+def test_matches_adopy(tmp_path):
+    ref = adopy.Engine(TaskDD(), ModelHyp(), GRID_DESIGN, GRID_PARAM)
+    res = compare_engines(ref, make_engine(tmp_path), n_trial=30, seed=0)
+    assert res['same_design'] == 1.
+    assert res['max_diff_mean'] < 1e-10
+    assert res['max_diff_sd'] < 1e-10
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'dtype': np.float32},
+    {'active_tol': 1e-6},
+    {'n_threads': 2, 'chunk_size': 16},
+])
+def test_variants_match_double_precision(cache_dir, kwargs):
+    ref = make_task_engine(cache_dir)
+    res = compare_engines(ref, make_task_engine(cache_dir, **kwargs),
+                          n_trial=30, seed=1)
+    assert res['same_design'] == 1.
+    assert res['max_diff_mean'] < 1e-6
+    assert res['max_diff_sd'] < 1e-6
+
+
+def test_tables_loaded_from_cache(tmp_path):
+    engine = make_engine(tmp_path)
+    assert engine.cache_path.exists()
+
+    cached = make_engine(tmp_path)
+    assert isinstance(cached.log_lik, np.memmap)
+    np.testing.assert_array_equal(cached.log_lik, engine.log_lik)
+    np.testing.assert_array_equal(cached.lik_ent, engine.lik_ent)
+
+
+def test_tables_loaded_from_cache_in_new_process(tmp_path):
+    # Cache keys should not depend on anything specific to a process, e.g.,
+    # memory addresses of code objects.
+    script = '; '.join([
+        'import numpy as np',
+        'from adopy.tasks.dd import TaskDD, ModelHyp',
+        'from ado_engine import Engine',
+        'engine = Engine(TaskDD(), ModelHyp(), {!r}, {!r}, cache_dir={!r})'
+        .format({k: list(v) for k, v in GRID_DESIGN.items()},
+                {k: list(v) for k, v in GRID_PARAM.items()}, str(tmp_path)),
+        'print(engine.cache_path.name, type(engine.log_lik).__name__)',
+    ])
+
+    outputs = []
+    for _ in range(2):
+        proc = subprocess.run(
+            [sys.executable, '-c', script], check=True,
+            stdout=subprocess.PIPE, universal_newlines=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        outputs.append(proc.stdout.split())
+
+    assert outputs[0][0] == outputs[1][0]
+    assert outputs[1][1] == 'memmap'
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_log_post_normalised_lazily(tmp_path):
+    engine = make_engine(tmp_path)
+    designs, responses = simulate(engine, 10)
+    for i in range(10):
+        engine.update(designs.iloc[i], responses[i])
+    assert not engine._log_post_normed
+
+    log_post = engine.log_post
+    assert engine._log_post_normed
+    assert abs(np.logaddexp.reduce(log_post)) < 1e-12
+    assert abs(engine.post.sum() - 1) < 1e-12
+
+
+def test_moments_cached_until_update(tmp_path):
+    engine = make_engine(tmp_path)
+    designs, responses = simulate(engine, 10)
+    for i in range(10):
+        engine.update(designs.iloc[i], responses[i])
+
+        post = np.exp(engine.log_post)
+        grid = engine.grid_param.values
+        mean = np.dot(post, grid)
+        cov = np.dot((grid - mean).T * post, grid - mean)
+        np.testing.assert_allclose(engine.post_mean, mean, rtol=1e-12)
+        np.testing.assert_allclose(engine.post_cov, cov, rtol=1e-10)
+        np.testing.assert_allclose(engine.post_sd, np.sqrt(np.diag(cov)),
+                                   rtol=1e-10)
+        assert engine.post_mean is engine.post_mean
+
+
+def test_update_by_index_matches_by_value(tmp_path):
+    by_index = make_engine(tmp_path)
+    by_value = make_engine(tmp_path)
+    for _ in range(10):
+        design = by_index.get_design()
+        assert by_index._get_design_index(design) == design.name
+
+        by_index.update(design, 1)
+        by_value.update(dict(design.items()), 1)
+        assert by_value._get_design_index(dict(design.items())) is None
+
+    np.testing.assert_allclose(by_index.log_post, by_value.log_post,
+                               atol=1e-12)
+
+
+def test_modified_design_is_not_taken_by_index(tmp_path):
+    engine = make_engine(tmp_path)
+    design = engine.get_design('random').copy()
+    design['r_ss'] += 25
+    assert engine._get_design_index(design) is None
+
+
+def test_off_grid_exact(tmp_path):
+    r_ss = [433., 618.3, 521.1]
+    responses = [1, 0, 1]
+
+    engine = make_engine(tmp_path, off_grid='exact')
+    ref = Engine(TaskDD(), ModelHyp(),
+                 {'t_ss': [0], 't_ll': [12.9], 'r_ss': r_ss, 'r_ll': [800]},
+                 GRID_PARAM)
+    for r, y in zip(r_ss, responses):
+        design = {'t_ss': 0, 't_ll': 12.9, 'r_ss': r, 'r_ll': 800}
+        engine.update(design, y)
+        ref.update(design, y)
+    np.testing.assert_allclose(engine.post_mean, ref.post_mean, rtol=1e-12)
+
+    engine.reset()
+    designs = pd.DataFrame({'t_ss': 0, 't_ll': 12.9, 'r_ss': r_ss,
+                            'r_ll': 800})
+    engine.update_batch(designs, responses)
+    np.testing.assert_allclose(engine.post_mean, ref.post_mean, rtol=1e-12)
+
+
+def test_off_grid_nearest_matches_adopy(tmp_path):
+    engine = make_engine(tmp_path)
+    ref = adopy.Engine(TaskDD(), ModelHyp(), GRID_DESIGN, GRID_PARAM)
+    design = {'t_ss': 0, 't_ll': 12.9, 'r_ss': 433., 'r_ll': 800}
+    engine.update(design, 1)
+    ref.update(design, 1)
+    np.testing.assert_allclose(engine.post_mean, ref.post_mean, rtol=1e-12)
+
+
+@pytest.mark.parametrize('lambda_et', [None, 0.5])
+def test_update_batch_matches_sequential(tmp_path, lambda_et):
+    seq = make_engine(tmp_path, lambda_et=lambda_et)
+    batch = make_engine(tmp_path, lambda_et=lambda_et)
+    designs, responses = simulate(seq, 100)
+
+    moments = []
+    for i in range(len(designs)):
+        seq.update(designs.iloc[i], responses[i])
+        moments.append(np.concatenate([seq.post_mean, seq.post_sd]))
+
+    df = batch.update_batch(designs, responses, return_moments=True)
+    assert list(df.columns) == ['mean_k', 'mean_tau', 'sd_k', 'sd_tau']
+    np.testing.assert_allclose(df.values, moments, rtol=1e-10, atol=1e-14)
+    np.testing.assert_allclose(batch.log_post, seq.log_post, atol=1e-10)
+    np.testing.assert_allclose(batch.eligibility_trace,
+                               seq.eligibility_trace)
+
+    batch.reset()
+    assert batch.update_batch(designs, responses) is None
+    np.testing.assert_allclose(batch.log_post, seq.log_post, atol=1e-10)
+
+
+def test_update_batch_in_single_precision(cache_dir):
+    seq = make_task_engine(cache_dir, dtype=np.float32)
+    batch = make_task_engine(cache_dir, dtype=np.float32)
+    designs, responses = simulate(seq, 500)
+
+    for i in range(len(designs)):
+        seq.update(designs.iloc[i], responses[i])
+    df = batch.update_batch(designs, responses, return_moments=True)
+    assert df.values.dtype == np.float64
+    np.testing.assert_allclose(df.values[-1],
+                               np.concatenate([seq.post_mean, seq.post_sd]),
+                               rtol=1e-10)
+    np.testing.assert_allclose(batch.log_post, seq.log_post, atol=1e-8)
+
+
+def test_update_batch_without_observations(tmp_path):
+    engine = make_engine(tmp_path)
+    log_post = engine.log_post.copy()
+    designs = pd.DataFrame(columns=engine.task.designs)
+
+    df = engine.update_batch(designs, [], return_moments=True)
+    assert list(df.columns) == ['mean_k', 'mean_tau', 'sd_k', 'sd_tau']
+    assert len(df) == 0
+    assert engine.update_batch(designs, []) is None
+    np.testing.assert_array_equal(engine.log_post, log_post)
+
+
+def test_refine_grid_stays_within_old_axes(tmp_path):
+    # On this axis, `np.logspace` over its points 14 to 16 starts one ulp
+    # below the old axis. With the posterior mass on the point 15, the
+    # credible interval (padded with one point) spans the points 14 to 16.
+    axis_k = np.logspace(-1.5128205128205128, 0, 30)
+    engine = Engine(TaskDD(), ModelHyp(), GRID_DESIGN,
+                    {'k': axis_k, 'tau': GRID_PARAM['tau']},
+                    cache_dir=tmp_path)
+
+    idx_k = np.searchsorted(axis_k, engine.grid_param['k'].values)
+    engine.log_post = np.where(idx_k == 15, 0., -50.)
+    engine.refine_grid()
+
+    axis_new = engine.grid_param_axes['k']
+    assert axis_new[0] == axis_k[14]
+    assert axis_new[-1] == axis_k[16]
+    assert np.all(np.isfinite(engine.log_post))
@@ -0,0 +1,110 @@
+"""
+Tests for the engine branches of `dd_psychopy_ado.py`, which compute the
+next design in the background. The script opens a PsychoPy window on
+import, so `branch_engine` is taken from its source code.
+"""
+
+import ast
+import copy
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import adopy
+from adopy.tasks.dd import TaskDD, ModelHyp
+
+from ado_engine import Engine
+
+# Smaller grids than in the task scripts, to keep the tests fast
+GRID_DESIGN = {
+    't_ss': [0],
+    't_ll': [0.43, 1, 4.3, 12.9, 26, 52, 156, 520],
+    'r_ss': np.arange(50, 800, 50),
+    'r_ll': [800]
+}
+GRID_PARAM = {
+    'k': np.logspace(-5, 0, 20),
+    'tau': np.linspace(0, 5, 10)
+}
+
+
+def load_branch_engine():
+    """Return `branch_engine` defined in the ADO task script."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'dd_psychopy_ado.py')
+    with open(path) as f:
+        tree = ast.parse(f.read())
+
+    body = [node for node in tree.body
+            if isinstance(node, ast.FunctionDef) and
+            node.name == 'branch_engine']
+    namespace = {'copy': copy}
+    exec(compile(ast.Module(body=body, type_ignores=[]), path, 'exec'),
+         namespace)
+    return namespace['branch_engine']
+
+
+def simulate_response(rng, engine, design, k=0.01, tau=1.):
+    args = dict(design.items())
+    args.update(k=k, tau=tau)
+    return int(rng.rand() < engine.model.compute(**args))
+
+
+def test_branch_matches_sequential_updates(tmp_path):
+    branch_engine = load_branch_engine()
+    rng = np.random.RandomState(0)
+    engine = Engine(TaskDD(), ModelHyp(), GRID_DESIGN, GRID_PARAM,
+                    cache_dir=tmp_path)
+    ref = adopy.Engine(TaskDD(), ModelHyp(), GRID_DESIGN, GRID_PARAM)
+
+    design = engine.get_design()
+    for _ in range(20):
+        assert design.name == ref.get_design().name
+        response = simulate_response(rng, engine, design)
+        log_post = engine.log_post.copy()
+        trace = engine.eligibility_trace.copy()
+
+        branch, design_next = branch_engine(engine, design, response)
+
+        # The given engine is left unchanged.
+        np.testing.assert_array_equal(engine.log_post, log_post)
+        np.testing.assert_array_equal(engine.eligibility_trace, trace)
+
+        ref.update(design, response)
+        np.testing.assert_allclose(branch.post_mean, ref.post_mean,
+                                   rtol=1e-10)
+        np.testing.assert_allclose(branch.post_sd, ref.post_sd, rtol=1e-10)
+        engine, design = branch, design_next
+
+
+def test_speculative_branches_on_threads(tmp_path):
+    branch_engine = load_branch_engine()
+    rng = np.random.RandomState(1)
+    engine = Engine(TaskDD(), ModelHyp(), GRID_DESIGN, GRID_PARAM,
+                    cache_dir=tmp_path)
+    ref = adopy.Engine(TaskDD(), ModelHyp(), GRID_DESIGN, GRID_PARAM)
+
+    design = engine.get_design()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        for _ in range(20):
+            # Compute the branches for both responses at the same time.
+            branches = {
+                y: executor.submit(branch_engine, engine, design, y)
+                for y in engine.task.responses
+            }
+            response = simulate_response(rng, engine, design)
+
+            for y, future in branches.items():
+                branch, design_next = future.result()
+                ref_y = copy.deepcopy(ref)
+                ref_y.update(design, y)
+                assert design_next.name == ref_y.get_design().name
+                np.testing.assert_allclose(branch.post_mean, ref_y.post_mean,
+                                           rtol=1e-10)
+                np.testing.assert_allclose(branch.post_sd, ref_y.post_sd,
+                                           rtol=1e-10)
+
+            # Commit the branch for the actual response.
+            ref.update(design, response)
+            engine, design = branches[response].result()
@@ -0,0 +1,80 @@
+"""
+Tests for the delay labels of the task scripts (`dd_psychopy_ado.py` and
+`dd_psychopy_non-ado.py`). The scripts open a PsychoPy window on import, so
+the labels and `convert_delay_to_str` are taken from their source code.
+"""
+
+import ast
+import os
+
+import numpy as np
+import pytest
+
+SCRIPTS = ['dd_psychopy_ado.py', 'dd_psychopy_non-ado.py']
+NAMES = ['DELAY_LABELS', 'DELAY_VALUES', 'DELAY_STRS', 'DELAY_MIDS',
+         'convert_delay_to_str']
+
+
+def load_script(filename):
+    """Run the definitions of the delay labels in a task script."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+    with open(path) as f:
+        tree = ast.parse(f.read())
+
+    body = []
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef):
+            names = [node.name]
+        elif isinstance(node, ast.Assign):
+            names = [t.id for t in node.targets if isinstance(t, ast.Name)]
+        else:
+            continue
+        if any(name in NAMES for name in names):
+            body.append(node)
+
+    namespace = {'np': np}
+    exec(compile(ast.Module(body=body, type_ignores=[]), path, 'exec'),
+         namespace)
+    return namespace
+
+
+def convert_delay_to_str_loop(delay_labels, delay):
+    """The original implementation, comparing with every delay in turn."""
+    mv, ms = None, None
+    for (v, s) in delay_labels.items():
+        if mv is None or np.square(delay - mv) > np.square(delay - v):
+            mv, ms = v, s
+    return ms
+
+
+def make_delays(values):
+    """Delays at, around, and far from the delays in the table."""
+    rng = np.random.RandomState(0)
+    mids = (values[:-1] + values[1:]) / 2
+    return np.concatenate([
+        values, -values,
+        mids, mids - 1e-12, mids + 1e-12,
+        np.nextafter(mids, np.inf), np.nextafter(mids, -np.inf),
+        [np.nan, np.inf, -np.inf, 1e19, 4e19, 1e20, 1e100, -1e100, 1e155,
+         1e300, 5e-324],
+        rng.uniform(-10, 600, 1000), 10 ** rng.uniform(-3, 25, 1000),
+    ])
+
+
+@pytest.mark.parametrize('filename', SCRIPTS)
+def test_convert_delay_to_str_matches_loop(filename):
+    script = load_script(filename)
+    convert = script['convert_delay_to_str']
+    delays = make_delays(script['DELAY_VALUES'])
+
+    with np.errstate(over='ignore', invalid='ignore'):
+        expected = [convert_delay_to_str_loop(script['DELAY_LABELS'], d)
+                    for d in delays]
+    assert list(convert(delays)) == expected
+    assert [convert(d) for d in delays] == expected
+    assert [convert(float(d)) for d in delays] == expected
+
+
+def test_scripts_have_same_labels():
+    ado, non_ado = [load_script(filename) for filename in SCRIPTS]
+    assert ado['DELAY_LABELS'] == non_ado['DELAY_LABELS']
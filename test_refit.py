@@ -0,0 +1,68 @@
+"""Tests for `refit.py`."""
+
+import numpy as np
+import pandas as pd
+
+from refit import make_engine, refit_sessions
+from trial_data import TrialLogger
+
+COLUMNS = ['block', 'trial', 't_ss', 't_ll', 'r_ss', 'r_ll', 'response',
+           'rt']
+
+GRID_PARAM = {
+    'k': np.logspace(-5, 0, 10),
+    'tau': np.linspace(0, 5, 5)
+}
+
+
+def write_session(path, seed, n_main=20):
+    """Write a session with random designs and responses."""
+    rng = np.random.RandomState(seed)
+    with TrialLogger(path, COLUMNS) as logger:
+        logger.write({'block': 'prac', 'trial': 1, 't_ss': 0, 't_ll': 1,
+                      'r_ss': 400, 'r_ll': 800, 'response': 1})
+        for i in range(n_main):
+            logger.write({
+                'block': 'main', 'trial': i + 1, 't_ss': 0,
+                't_ll': rng.choice([0.43, 4.3, 26, 520]),
+                'r_ss': 12.5 * rng.randint(1, 64), 'r_ll': 800,
+                'response': rng.randint(2), 'rt': 0.5,
+            })
+
+
+def test_refit_matches_update_batch(tmp_path):
+    path_data = tmp_path / 'data'
+    path_data.mkdir()
+    paths = [str(path_data / 'ddt_20190724130{}.csv'.format(i))
+             for i in range(3)]
+    for i, path in enumerate(paths):
+        write_session(path, seed=i)
+
+    # A session truncated by a crash, without the column of responses
+    path_broken = path_data / 'ddt_201907241310.csv'
+    path_broken.write_text('block,trial,t_ss\nmain,1,0\n')
+
+    path_output = tmp_path / 'refit.csv'
+    skipped = refit_sessions(paths + [str(path_broken)], 'ModelHyp',
+                             GRID_PARAM, path_output, tmp_path / 'cache',
+                             processes=2)
+    assert skipped == [str(path_broken)]
+
+    df = pd.read_csv(path_output).set_index('session')
+    assert sorted(df.index) == ['ddt_201907241300', 'ddt_201907241301',
+                                'ddt_201907241302']
+
+    engine = make_engine('ModelHyp', GRID_PARAM, tmp_path / 'cache')
+    for path in paths:
+        trials = pd.read_csv(path)
+        trials = trials[trials['block'] == 'main']
+        engine.log_post = engine.log_prior.copy()
+        engine.update_batch(trials[engine.task.designs],
+                            trials['response'].values)
+
+        row = df.loc['ddt_' + path.split('_')[-1][:-4]]
+        assert row['n_trials'] == 20
+        np.testing.assert_allclose(row[['mean_k', 'mean_tau']],
+                                   engine.post_mean, rtol=1e-10)
+        np.testing.assert_allclose(row[['sd_k', 'sd_tau']],
+                                   engine.post_sd, rtol=1e-10)
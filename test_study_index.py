@@ -0,0 +1,111 @@
+"""Tests for `study_index.py`."""
+
+import os
+
+import numpy as np
+import pytest
+
+from study_index import StudyIndex, is_session_file
+from trial_data import (
+    ColumnarTrialLogger, PosteriorCheckpoint, PosteriorHistory, TrialLogger
+)
+
+COLUMNS = ['block', 'trial', 't_ss', 't_ll', 'r_ss', 'r_ll', 'response',
+           'rt', 'mean_k', 'mean_tau', 'sd_k', 'sd_tau']
+
+
+def write_session(path, mean_k, n_main=5):
+    cls = TrialLogger if path.suffix == '.csv' else ColumnarTrialLogger
+    with cls(path, COLUMNS) as logger:
+        logger.write({'block': 'prac', 'trial': 1, 'response': 1})
+        for i in range(n_main):
+            logger.write({
+                'block': 'main', 'trial': i + 1,
+                't_ss': 0, 't_ll': 4.3, 'r_ss': 400, 'r_ll': 800,
+                'response': i % 2, 'rt': 0.5,
+                'mean_k': mean_k, 'mean_tau': 1., 'sd_k': 0.1, 'sd_tau': 0.2,
+            })
+
+
+@pytest.fixture
+def path_data(tmp_path):
+    write_session(tmp_path / 'ddt_201907241300.csv', 0.01)
+    write_session(tmp_path / 'ddt_201907251300.npz', 0.1)
+    write_session(tmp_path / 'ddt_201908011300.csv', 0.5)
+    return tmp_path
+
+
+def test_update_ingests_sessions(path_data):
+    index = StudyIndex(path_data)
+    assert index.update() == 3
+    assert (path_data / 'study.npz').exists()
+
+    assert index.sessions['session'].tolist() == [
+        'ddt_201907241300', 'ddt_201907251300', 'ddt_201908011300']
+    assert index.sessions['n_trials'].tolist() == [6, 6, 6]
+    assert index.sessions['n_main'].tolist() == [5, 5, 5]
+    np.testing.assert_allclose(index.sessions['mean_k'], [0.01, 0.1, 0.5])
+    assert len(index.trials) == 18
+
+
+def test_reopen_without_changes(path_data):
+    StudyIndex(path_data).update()
+    mtime = os.stat(str(path_data / 'study.npz')).st_mtime_ns
+
+    index = StudyIndex(path_data)
+    assert len(index.sessions) == 3
+    assert index.update() == 0
+    assert os.stat(str(path_data / 'study.npz')).st_mtime_ns == mtime
+
+
+def test_update_is_incremental(path_data):
+    StudyIndex(path_data).update()
+
+    # Add a session, modify a session, and remove a session.
+    write_session(path_data / 'ddt_201909011300.csv', 0.2)
+    write_session(path_data / 'ddt_201907241300.csv', 0.03, n_main=8)
+    os.remove(str(path_data / 'ddt_201908011300.csv'))
+
+    index = StudyIndex(path_data)
+    assert index.update() == 2
+
+    sessions = index.sessions.set_index('session')
+    assert sorted(sessions.index) == [
+        'ddt_201907241300', 'ddt_201907251300', 'ddt_201909011300']
+    assert sessions.loc['ddt_201907241300', 'n_main'] == 8
+    assert sessions.loc['ddt_201907241300', 'mean_k'] == 0.03
+    assert index.sessions['session_id'].is_unique
+    assert len(index.trials) == 9 + 6 + 6
+    assert set(index.trials['session_id']) == \
+        set(index.sessions['session_id'])
+
+
+def test_select_sessions_and_trials(path_data):
+    index = StudyIndex(path_data)
+    index.update()
+
+    sessions = index.select_sessions(start='2019-07-25', end='2019-07-31')
+    assert sessions['session'].tolist() == ['ddt_201907251300']
+
+    sessions = index.select_sessions(mean_k=(0.05, None))
+    assert sessions['session'].tolist() == [
+        'ddt_201907251300', 'ddt_201908011300']
+
+    trials = index.get_trials(sessions, block='main')
+    assert len(trials) == 10
+    assert (trials['block'] == 'main').all()
+
+
+def test_side_files_are_skipped(path_data):
+    history = PosteriorHistory(3)
+    history.append(np.full(3, 1 / 3))
+    history.save(path_data / 'ddt_201907241300_history.npz')
+    PosteriorCheckpoint(path_data / 'ddt_201907241300_post.npy', 3).close()
+
+    assert not is_session_file(path_data / 'ddt_201907241300_history.npz')
+    assert not is_session_file(path_data / 'ddt_201907241300_post.npy')
+    assert is_session_file(path_data / 'ddt_201907251300.npz')
+
+    index = StudyIndex(path_data)
+    assert index.update() == 3
+    assert len(index.sessions) == 3
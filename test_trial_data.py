@@ -0,0 +1,344 @@
+"""Tests for `trial_data.py`."""
+
+import os
+import subprocess
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from trial_data import (
+    AsyncTrialLogger, ColumnarTrialLogger, PosteriorCheckpoint,
+    PosteriorHistory, TrialLogger, TrialStore, read_session
+)
+
+COLUMNS = [
+    'block', 'trial',
+    't_ss', 't_ll', 'r_ss', 'r_ll',
+    'is_ll_on_left', 'key_left', 'response', 'rt',
+    'mean_k', 'mean_tau', 'sd_k', 'sd_tau'
+]
+
+
+def make_row(i, block='main'):
+    return {
+        'block': block, 'trial': i + 1,
+        't_ss': 0., 't_ll': 4.3, 'r_ss': 12.5 * (i + 1), 'r_ll': 800.,
+        'is_ll_on_left': i % 2, 'key_left': 1, 'response': i % 2,
+        'rt': 0.5 + i, 'mean_k': 0.01, 'mean_tau': 1., 'sd_k': 0.1,
+        'sd_tau': 0.2,
+    }
+
+
+###############################################################################
+# TrialStore
+###############################################################################
+
+
+def test_store_grows_by_doubling():
+    store = TrialStore(COLUMNS, capacity=2)
+    for i in range(5):
+        store.append(make_row(i))
+    assert len(store) == 5
+    assert store.capacity == 8
+
+    df = store.to_dataframe()
+    assert list(df.columns) == COLUMNS
+    assert df['trial'].tolist() == [1, 2, 3, 4, 5]
+    assert df['block'].tolist() == ['main'] * 5
+
+
+def test_store_fills_missing_values():
+    store = TrialStore(COLUMNS + ['note'])
+    store.append({'block': 'prac', 'note': 'x'})
+    row = store.to_dataframe().iloc[0]
+    assert np.isnan(row['rt'])
+    assert row['response'] == -1
+    assert row['note'] == 'x'
+    assert store.data['block'][0] == 'prac'
+
+
+def test_store_to_dataframe_does_not_copy_numbers():
+    store = TrialStore(COLUMNS)
+    store.append(make_row(0))
+    df = store.to_dataframe()
+    assert np.shares_memory(df['rt'].values, store.data)
+    assert np.shares_memory(df['trial'].values, store.data)
+
+
+def test_store_extend():
+    store = TrialStore(COLUMNS, capacity=1)
+    store.append(make_row(0, 'prac'))
+    df = pd.DataFrame([make_row(i) for i in range(3)], columns=COLUMNS)
+    df.loc[1, 'response'] = np.nan
+    store.extend(df)
+
+    out = store.to_dataframe()
+    assert len(out) == 4
+    assert out['block'].tolist() == ['prac', 'main', 'main', 'main']
+    assert out['response'].tolist() == [0, 0, -1, 0]
+    np.testing.assert_array_equal(out['rt'].values[1:], df['rt'].values)
+
+
+###############################################################################
+# Trial loggers
+###############################################################################
+
+
+@pytest.mark.parametrize('cls', [TrialLogger, AsyncTrialLogger])
+@pytest.mark.parametrize('durability', ['row', 'fsync', 'block'])
+def test_logger_writes_csv(tmp_path, cls, durability):
+    path = tmp_path / 'ddt.csv'
+    logger = cls(path, COLUMNS, durability=durability, fsync_every=2)
+    for i in range(3):
+        logger.write(make_row(i, 'prac'))
+    logger.end_block()
+    for i in range(4):
+        logger.write(make_row(i))
+    logger.close()
+
+    df, margs = read_session(path)
+    assert margs == {}
+    assert len(df) == 7
+    assert df['block'].tolist() == ['prac'] * 3 + ['main'] * 4
+    pd.testing.assert_frame_equal(df, logger.to_dataframe(),
+                                  check_dtype=False)
+
+
+def test_logger_appends_to_csv(tmp_path):
+    path = tmp_path / 'ddt.csv'
+    with TrialLogger(path, COLUMNS) as logger:
+        logger.write(make_row(0))
+    with AsyncTrialLogger(path, COLUMNS, append=True) as logger:
+        logger.write(make_row(1))
+
+    df, _ = read_session(path)
+    assert df['trial'].tolist() == [1, 2]
+    assert logger.to_dataframe()['trial'].tolist() == [1, 2]
+
+
+def test_columnar_logger_saves_marginals(tmp_path):
+    path = tmp_path / 'ddt.npz'
+    grid = np.linspace(0, 1, 5)
+    marg = np.full(5, 0.2)
+
+    with ColumnarTrialLogger(path, COLUMNS, marginals=True) as logger:
+        logger.write(make_row(0, 'prac'))
+        logger.write(make_row(0), marginals={'k': marg}, grids={'k': grid})
+    with ColumnarTrialLogger(path, COLUMNS, marginals=True,
+                             append=True) as logger:
+        logger.write(make_row(1), marginals={'k': marg}, grids={'k': grid})
+
+    df, margs = read_session(path)
+    assert df['block'].tolist() == ['prac', 'main', 'main']
+    assert df['rt'].dtype == np.float64
+
+    grids, margs_k = margs['k']
+    assert margs_k.dtype == np.float16
+    assert np.isnan(margs_k[0]).all()
+    np.testing.assert_allclose(margs_k[1:], [marg, marg], rtol=1e-3)
+    np.testing.assert_array_equal(grids[2], grid)
+
+
+def test_columnar_logger_saves_every_rows_on_writer(tmp_path):
+    path = tmp_path / 'ddt.npz'
+    logger = ColumnarTrialLogger(path, COLUMNS, save_every=2)
+
+    # Record the thread and the number of rows of each save.
+    saves = []
+    write = logger._write
+
+    def record(snapshot):
+        saves.append((threading.current_thread().name, len(snapshot[0])))
+        write(snapshot)
+
+    logger._write = record
+    for i in range(6):
+        logger.write(make_row(i))
+    logger.close()
+
+    assert saves[-1] == (threading.current_thread().name, 6)
+    writer = [n for name, n in saves if name == 'ColumnarTrialLogger']
+    assert len(writer) > 0
+    assert all(n % 2 == 0 for n in writer)
+    assert writer == sorted(writer)
+    assert len(read_session(path)[0]) == 6
+
+
+def test_columnar_logger_keeps_latest_rows(tmp_path):
+    path = tmp_path / 'ddt.npz'
+    logger = ColumnarTrialLogger(path, COLUMNS)
+    logger.write(make_row(0))
+    old = logger._snapshot()
+    logger.write(make_row(1))
+    logger.save()
+
+    # A snapshot taken before the last save does not replace the file.
+    logger._write(old)
+    assert len(read_session(path)[0]) == 2
+    logger.close()
+
+
+def test_columnar_logger_saves_at_exit(tmp_path):
+    # Exit Python with an error in the middle of a block, without closing
+    # the logger.
+    path = tmp_path / 'ddt.npz'
+    script = '; '.join([
+        'from trial_data import ColumnarTrialLogger',
+        'logger = ColumnarTrialLogger({!r}, {!r})'.format(str(path), COLUMNS),
+        'logger.write({\'block\': \'main\', \'trial\': 1})',
+        'raise KeyboardInterrupt',
+    ])
+    proc = subprocess.run([sys.executable, '-c', script],
+                          cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert proc.returncode != 0
+    assert read_session(path)[0]['trial'].tolist() == [1]
+
+
+def test_columnar_logger_rejects_marginals_in_parquet(tmp_path):
+    with pytest.raises(ValueError):
+        ColumnarTrialLogger(tmp_path / 'ddt.parquet', COLUMNS,
+                            marginals=True)
+
+
+###############################################################################
+# PosteriorCheckpoint
+###############################################################################
+
+
+def test_checkpoint_ring(tmp_path):
+    path = tmp_path / 'post.npy'
+    checkpoint = PosteriorCheckpoint(path, 3, size=4)
+    assert checkpoint.load() == (0, None)
+
+    for n in range(1, 7):
+        checkpoint.save(n, np.full(3, float(n)))
+    n_done, log_post = checkpoint.load()
+    assert n_done == 6
+    np.testing.assert_array_equal(log_post, [6., 6., 6.])
+    checkpoint.close()
+
+    resumed = PosteriorCheckpoint(path, 3, resume=True)
+    assert resumed.load()[0] == 6
+    resumed.close()
+
+
+def test_checkpoint_follows_saved_rows(tmp_path):
+    checkpoint = PosteriorCheckpoint(tmp_path / 'post.npy', 3, size=4)
+    for n in range(1, 7):
+        checkpoint.save(n, np.full(3, float(n)))
+
+    # Only four rows reached the file before a crash.
+    n_done, log_post = checkpoint.load(n_max=4)
+    assert n_done == 4
+    np.testing.assert_array_equal(log_post, [4., 4., 4.])
+    assert checkpoint.load(n_max=10)[0] == 6
+
+    # Rows older than every slot of the ring are replayed from the prior.
+    assert checkpoint.load(n_max=2) == (0, None)
+
+
+def test_checkpoint_truncated_on_resume(tmp_path):
+    path = tmp_path / 'post.npy'
+    checkpoint = PosteriorCheckpoint(path, 3, size=4)
+    for n in range(1, 7):
+        checkpoint.save(n, np.full(3, float(n)))
+    checkpoint.close()
+
+    # Resume after four rows, then crash after writing the fifth row but
+    # before its checkpoint.
+    resumed = PosteriorCheckpoint(path, 3, resume=True)
+    assert resumed.load(n_max=4)[0] == 4
+    resumed.truncate(4)
+    assert resumed.load()[0] == 4
+    resumed.close()
+
+    # The checkpoint of the fifth trial of the crashed run is not loaded.
+    resumed = PosteriorCheckpoint(path, 3, resume=True)
+    n_done, log_post = resumed.load(n_max=5)
+    assert n_done == 4
+    np.testing.assert_array_equal(log_post, [4., 4., 4.])
+    resumed.close()
+
+
+def test_checkpoint_ignores_half_written_slot(tmp_path):
+    checkpoint = PosteriorCheckpoint(tmp_path / 'post.npy', 3, size=4)
+    checkpoint.save(1, np.zeros(3))
+    checkpoint.save(2, np.ones(3))
+
+    # A crash while saving the third checkpoint leaves its slot empty.
+    checkpoint._mm[3, 0] = -1
+    checkpoint._mm[3, 1:] = 3.
+    assert checkpoint.load()[0] == 2
+
+
+def test_checkpoint_rejects_other_grid(tmp_path):
+    path = tmp_path / 'post.npy'
+    PosteriorCheckpoint(path, 3).close()
+    with pytest.raises(ValueError):
+        PosteriorCheckpoint(path, 4, resume=True)
+
+
+###############################################################################
+# PosteriorHistory
+###############################################################################
+
+
+def make_posts(n_trial, n_param=200, seed=0):
+    """Posteriors concentrating over trials, as in a session."""
+    rng = np.random.RandomState(seed)
+    x = np.linspace(-5, 5, n_param)
+    posts = []
+    for t in range(n_trial):
+        p = np.exp(-0.5 * (x - 0.1 * rng.randn()) ** 2 * (1 + t))
+        posts.append(p / p.sum())
+    return posts
+
+
+def test_history_reconstructs_within_tolerance():
+    posts = make_posts(50)
+    history = PosteriorHistory(200, keyframe_every=8, tol=1e-8)
+    for p in posts:
+        history.append(p)
+
+    assert len(history) == 50
+    assert history.nbytes < 50 * 200 * 8
+    for t in range(50):
+        np.testing.assert_allclose(history[t], posts[t], atol=2e-8)
+    np.testing.assert_array_equal(history[-1], history[49])
+    with pytest.raises(IndexError):
+        history[50]
+
+
+def test_history_round_trip(tmp_path):
+    history = PosteriorHistory(200, keyframe_every=8, start=5)
+    for p in make_posts(20):
+        history.append(p)
+    history.save(tmp_path / 'history.npz')
+
+    loaded = PosteriorHistory.load(tmp_path / 'history.npz')
+    assert (loaded.first, len(loaded)) == (5, 25)
+    for t in range(5, 25):
+        np.testing.assert_array_equal(loaded[t], history[t])
+
+    # The loaded history can be continued.
+    post = make_posts(1, seed=1)[0]
+    history.append(post)
+    loaded.append(post)
+    np.testing.assert_array_equal(loaded[-1], history[-1])
+
+
+def test_history_evicts_oldest_segments():
+    posts = make_posts(40)
+    history = PosteriorHistory(200, keyframe_every=10, max_bytes=2000)
+    for p in posts:
+        history.append(p)
+
+    assert history.nbytes <= 2000 or len(history._segments) == 1
+    assert history.first > 0
+    assert history.first % 10 == 0
+    with pytest.raises(IndexError):
+        history[0]
+    np.testing.assert_allclose(history[39], posts[39], atol=2e-8)
@@ -0,0 +1,913 @@
+"""
+Trial-by-trial data of a task session
+=====================================
+
+This module provides `TrialLogger`, which saves trial-by-trial data of the
+PsychoPy-based implementations of the delay discounting task
+(`dd_psychopy_ado.py` and `dd_psychopy_non-ado.py`) into a CSV file.
+
+Appending a row to a DataFrame and then rewriting the whole CSV file on every
+trial copies the whole data and rewrites the whole file each time, which
+grows over a session and stalls the trial loop. Instead, `TrialLogger` writes
+the header once and appends a single row per trial. At the end of the
+session, `to_dataframe()` returns the whole data as a DataFrame.
+
+How soon the rows reach the disk is set by a durability policy:
+
+* ``'row'``: flush every row to the file right away (default).
+* ``'fsync'``: flush every row, and force the file to the disk with
+  `os.fsync` every `fsync_every` rows.
+* ``'block'``: force the file to the disk only at the end of each block,
+  i.e., on `end_block()`, and on `close()`.
+
+Even an append-only write takes tens of milliseconds on network home
+directories. `AsyncTrialLogger` passes the rows through a bounded queue to
+a writer thread, so writing never runs in the trial loop. The writer drains
+the queue when the logger is closed, including at the exit of Python (e.g.,
+on `core.quit()` of PsychoPy).
+
+If the task crashes in the middle of a session, the output file keeps the
+responses, but the posterior of the ADOpy engine lives only in memory.
+`PosteriorCheckpoint` writes the log posterior after each update into a ring
+of slots in a preallocated memory-mapped `.npy` file, so that a session can
+be resumed from the last checkpoint in O(grid) time instead of replaying all
+trials. A logger opened with `append=True` continues the output file of the
+resumed session. Rows still queued for writing are lost in a crash, so
+a session resumes from the last checkpoint covered by the rows in the file
+(`load(n_max=...)`), replaying only the rows saved after it, and the
+checkpoints of the lost rows are discarded (`truncate`).
+
+Analysing thousands of sessions from text files means parsing text again and
+again. `ColumnarTrialLogger` is an alternative backend that saves typed
+columns into a binary file, either NumPy's `.npz` or Parquet (which needs
+`pyarrow` or `fastparquet`). With `.npz`, it can also save the marginal
+posterior of each parameter after every trial, compressed into float16.
+The whole file is rewritten at the end of each block and at the exit of
+Python. With `save_every`, it is also rewritten every few rows on a writer
+thread, which only writes the latest rows, so the trial loop never waits for
+the compression. `read_session` loads a whole session back in a single read.
+
+`PosteriorHistory` keeps the full posterior after every trial, e.g., to plot
+how the posterior contracts over a session. Consecutive posteriors are highly
+correlated and mostly near zero, so it keeps a keyframe every few trials and
+sparse deltas between them, dropping entries below a tolerance, with random
+access to the posterior after any trial and an optional cap on its memory.
+
+All loggers keep the rows of a session in memory in a `TrialStore`, a NumPy
+structured array with a typed field for each column, preallocated and grown
+by doubling. Adding a row only sets the fields of a record, without
+allocating a dictionary or a Series for it, and `to_dataframe()` returns the
+numeric columns as views on the array without copying them.
+
+Prerequisites
+-------------
+* Python 3.5 or above
+* Numpy
+* Pandas
+"""
+
+###############################################################################
+# Load depandancies
+###############################################################################
+
+# To write CSV files and to handle paths for files and directories
+import csv
+import os
+from pathlib import Path
+
+# To write files on a separate thread
+import atexit
+import queue
+import threading
+
+# Fundamental packages for handling vectors, matrices, and dataframes
+import numpy as np
+import pandas as pd
+
+__all__ = [
+    'TrialStore', 'TrialLogger', 'AsyncTrialLogger', 'ColumnarTrialLogger',
+    'PosteriorCheckpoint', 'PosteriorHistory', 'read_session'
+]
+
+###############################################################################
+# Global variables
+###############################################################################
+
+# Durability policies to save rows into the disk
+DURABILITY = ['row', 'fsync', 'block']
+
+# Data types of the columns of the task scripts in a `TrialStore`. Columns
+# not listed here are stored as Python objects.
+TRIAL_DTYPES = {
+    'block': 'U16',
+    'trial': np.int64,
+    't_ss': np.float64,
+    't_ll': np.float64,
+    'r_ss': np.float64,
+    'r_ll': np.float64,
+    'is_ll_on_left': np.int64,
+    'key_left': np.int64,
+    'response': np.int64,
+    'rt': np.float64,
+    'onset': np.float64,
+    'n_frames': np.int64,
+    'n_dropped': np.int64,
+    'mean_k': np.float64,
+    'mean_tau': np.float64,
+    'sd_k': np.float64,
+    'sd_tau': np.float64,
+}
+
+
+###############################################################################
+# Trial store
+###############################################################################
+
+
+class TrialStore(object):
+    """
+    Trial-by-trial data kept in a preallocated NumPy structured array, with
+    a field for each column. When the array is full, it is reallocated with
+    twice the capacity, so adding a row takes amortised constant time.
+
+    Values missing in a row are stored as NaN for float columns, -1 for
+    integer columns, an empty string for string columns, and None for object
+    columns.
+
+    Parameters
+    ----------
+    columns : List[str]
+        Column labels of the data.
+    dtypes : Dict[str, dtype], optional
+        Data type of each column. Defaults to `TRIAL_DTYPES` for the columns
+        of the task scripts, and to object for the other columns.
+    capacity : int, optional
+        Initial number of rows to allocate.
+    """
+
+    def __init__(self, columns, dtypes=None, capacity=64):
+        self.columns = list(columns)
+        dtypes = dict(TRIAL_DTYPES, **(dtypes or {}))
+        self.dtype = np.dtype([
+            (col, dtypes.get(col, object)) for col in self.columns
+        ])
+
+        # Value of each column for missing values
+        self._fill = tuple([
+            {'f': np.nan, 'i': -1, 'U': ''}.get(self.dtype[col].kind, None)
+            for col in self.columns
+        ])
+
+        self._data = np.empty(max(capacity, 1), dtype=self.dtype)
+        self._n = 0
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def capacity(self):
+        """Number of rows allocated."""
+        return len(self._data)
+
+    @property
+    def data(self):
+        """The structured array of the rows added so far (a view)."""
+        return self._data[:self._n]
+
+    def append(self, row):
+        """Add a row of a trial, given as a dictionary."""
+        if self._n == len(self._data):
+            self._grow(2 * len(self._data))
+
+        # Set all the fields of the record at once from a tuple.
+        self._data[self._n] = tuple([
+            row.get(col, fill) for col, fill in zip(self.columns, self._fill)
+        ])
+        self._n += 1
+
+    def extend(self, df):
+        """Add the rows of a DataFrame."""
+        n = len(df)
+        if self._n + n > len(self._data):
+            self._grow(max(2 * len(self._data), self._n + n))
+
+        block = self._data[self._n:self._n + n]
+        block[:] = self._fill
+        for col in self.columns:
+            if col in df.columns:
+                values = df[col]
+                kind = self.dtype[col].kind
+                if kind == 'U':
+                    values = ['' if pd.isnull(v) else str(v) for v in values]
+                elif kind == 'i':
+                    values = values.fillna(-1).to_numpy()
+                else:
+                    values = values.to_numpy()
+                block[col] = values
+        self._n += n
+
+    def to_dataframe(self):
+        """
+        Return the rows as a DataFrame. Numeric columns are views on the
+        store, not copies, so the DataFrame should not be modified in place.
+        """
+        data = self.data
+        return pd.DataFrame({col: data[col] for col in self.columns},
+                            columns=self.columns, copy=False)
+
+    def _grow(self, capacity):
+        """Reallocate the array with the given capacity."""
+        data = np.empty(capacity, dtype=self.dtype)
+        data[:self._n] = self._data[:self._n]
+        self._data = data
+
+
+###############################################################################
+# Trial loggers
+###############################################################################
+
+
+class TrialLogger(object):
+    """
+    A logger that appends trial-by-trial data into a CSV file.
+
+    Parameters
+    ----------
+    path : Path
+        Path to the output CSV file. An existing file is overwritten.
+    columns : List[str]
+        Column labels of the output data. Values for columns missing in
+        a row are left empty.
+    durability : {'row', 'fsync', 'block'}, optional
+        Policy to save rows into the disk.
+    fsync_every : int, optional
+        Number of rows between `os.fsync` calls with the ``'fsync'`` policy.
+    append : bool, optional
+        If True and the file exists, append rows to it (e.g., to resume
+        a session) instead of overwriting it.
+    """
+
+    def __init__(self, path, columns, durability='row', fsync_every=10,
+                 append=False):
+        if durability not in DURABILITY:
+            raise ValueError('The argument durability should be one of {}.'
+                             .format(DURABILITY))
+
+        self.path = Path(path)
+        self.columns = list(columns)
+        self.durability = durability
+        self.fsync_every = fsync_every
+        self.store = TrialStore(self.columns)
+
+        # Keep the rows already in the file when appending to it.
+        append = append and self.path.exists() and \
+            self.path.stat().st_size > 0
+        if append:
+            self.store.extend(pd.read_csv(str(self.path)))
+
+        self._n_unsynced = 0
+        self._file = self.path.open('a' if append else 'w', newline='')
+        self._writer = csv.DictWriter(self._file, fieldnames=self.columns,
+                                      restval='')
+        if not append:
+            self._writer.writeheader()
+            self._file.flush()
+
+    def write(self, row, marginals=None, grids=None):
+        """
+        Append a row of a trial, given as a dictionary, into the file.
+        Marginal posteriors are saved only by `ColumnarTrialLogger`, so
+        `marginals` and `grids` are ignored here.
+        """
+        self._write_row(row)
+        self.store.append(row)
+
+    def end_block(self):
+        """Mark the end of a block."""
+        self._end_block()
+
+    def to_dataframe(self):
+        """Return all the rows written so far as a DataFrame."""
+        return self.store.to_dataframe()
+
+    def close(self):
+        """Save all the rows into the disk and close the output file."""
+        if not self._file.closed:
+            self._sync()
+            self._file.close()
+
+    def _write_row(self, row):
+        """Write a row into the file according to the durability policy."""
+        self._writer.writerow(row)
+        self._n_unsynced += 1
+
+        if self.durability == 'row':
+            self._file.flush()
+        elif self.durability == 'fsync':
+            self._file.flush()
+            if self._n_unsynced >= self.fsync_every:
+                self._sync()
+
+    def _end_block(self):
+        """Save the rows into the disk at the end of a block if needed."""
+        if self.durability == 'block':
+            self._sync()
+
+    def _sync(self):
+        """Flush the file and force it to the disk."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._n_unsynced = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AsyncTrialLogger(TrialLogger):
+    """
+    A trial logger that writes rows on a separate writer thread. Rows are
+    passed to the writer through a bounded queue; if the queue is full,
+    `write` waits until the writer catches up.
+
+    Parameters
+    ----------
+    path : Path
+        Path to the output CSV file. An existing file is overwritten.
+    columns : List[str]
+        Column labels of the output data. Values for columns missing in
+        a row are left empty.
+    durability : {'row', 'fsync', 'block'}, optional
+        Policy to save rows into the disk.
+    fsync_every : int, optional
+        Number of rows between `os.fsync` calls with the ``'fsync'`` policy.
+    append : bool, optional
+        If True and the file exists, append rows to it (e.g., to resume
+        a session) instead of overwriting it.
+    maxsize : int, optional
+        Maximum number of rows waiting in the queue.
+    """
+
+    def __init__(self, path, columns, durability='row', fsync_every=10,
+                 append=False, maxsize=256):
+        super(AsyncTrialLogger, self).__init__(
+            path, columns, durability=durability, fsync_every=fsync_every,
+            append=append)
+
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='AsyncTrialLogger')
+        self._thread.start()
+
+        # Drain the queue at the exit of Python, e.g., on `core.quit()`.
+        atexit.register(self.close)
+
+    def write(self, row, marginals=None, grids=None):
+        """
+        Pass a row of a trial, given as a dictionary, to the writer.
+        `marginals` and `grids` are ignored as in `TrialLogger`.
+        """
+        self._check_error()
+        self._queue.put(('row', row))
+        self.store.append(row)
+
+    def end_block(self):
+        """Mark the end of a block."""
+        self._check_error()
+        self._queue.put(('block', None))
+
+    def close(self):
+        """
+        Wait until the writer saves all the rows in the queue, then close
+        the output file.
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        atexit.unregister(self.close)
+
+        super(AsyncTrialLogger, self).close()
+        self._check_error()
+
+    def _run(self):
+        """Write rows in the queue until the logger is closed."""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            # After an error, keep draining the queue so that `write` never
+            # blocks; the error is raised on the main thread instead.
+            if self._error is not None:
+                continue
+
+            kind, row = item
+            try:
+                if kind == 'row':
+                    self._write_row(row)
+                else:
+                    self._end_block()
+            except Exception as e:
+                self._error = e
+
+    def _check_error(self):
+        """Raise an error that occurred on the writer thread, if any."""
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+class ColumnarTrialLogger(object):
+    """
+    A logger that saves trial-by-trial data as typed columns into a binary
+    file, i.e., `.npz` or `.parquet` according to the suffix of the path.
+    Rows are kept in memory and the whole file is written at the end of each
+    block and on `close()`, including at the exit of Python. With
+    `save_every`, the file is also written every `save_every` rows by
+    a writer thread; if rows are added faster than the file is written, the
+    writer skips to the latest rows.
+
+    With `.npz`, the marginal posterior of each parameter after a trial can
+    be given to `write`. Each is saved as a float16 array with a row for each
+    trial (`marg_<param>`), along with the grid of the parameter (as float64,
+    `grid_<param>`); rows for trials without marginals are NaN.
+
+    Parameters
+    ----------
+    path : Path
+        Path to the output file, ending with `.npz` or `.parquet`.
+    columns : List[str]
+        Column labels of the output data. Values for columns missing in
+        a row are saved as NaN.
+    marginals : bool, optional
+        Whether to save the marginal posteriors given to `write`.
+    append : bool, optional
+        If True and the file exists, keep the data in it (e.g., to resume
+        a session) instead of overwriting it.
+    save_every : int, optional
+        If given, also save the file every `save_every` rows on a writer
+        thread, e.g., 1 to keep the file up to date with checkpoints of the
+        posterior.
+    """
+
+    def __init__(self, path, columns, marginals=False, append=False,
+                 save_every=None):
+        self.path = Path(path)
+        self.columns = list(columns)
+        self.marginals = marginals
+        self.save_every = save_every
+        self.store = TrialStore(self.columns)
+
+        self.format = self.path.suffix.lstrip('.')
+        if self.format not in ('npz', 'parquet'):
+            raise ValueError('The path should end with .npz or .parquet.')
+        if marginals and self.format != 'npz':
+            raise ValueError('Marginal posteriors are only saved in .npz.')
+
+        # Marginal posteriors and grids for each row, by parameter
+        self._margs = {}
+        self._grids = {}
+
+        if append and self.path.exists():
+            df, margs = read_session(self.path)
+            self.store.extend(df)
+            for name, (grid, marg) in margs.items():
+                self._grids[name] = list(grid)
+                self._margs[name] = list(marg)
+
+        # Snapshots of the rows to save, passed to the writer thread. Only
+        # the latest one is kept, and a file is never replaced by one with
+        # fewer rows.
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._pending = None
+        self._closing = False
+        self._n_saved = 0
+        self._error = None
+        self._thread = None
+        if save_every:
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name='ColumnarTrialLogger')
+            self._thread.start()
+
+        # Save the rows kept in memory at the exit of Python, e.g., on
+        # `core.quit()` of PsychoPy.
+        atexit.register(self.close)
+
+    def write(self, row, marginals=None, grids=None):
+        """
+        Add a row of a trial, given as a dictionary. If `marginals` is
+        given, it should be a dictionary of the marginal posterior of each
+        parameter, with the grid of each parameter in `grids`.
+        """
+        self._check_error()
+        self.store.append(row)
+        if self.marginals:
+            self._append_marginals(marginals, grids)
+
+        if self.save_every and len(self.store) % self.save_every == 0:
+            with self._cond:
+                self._pending = self._snapshot()
+                self._cond.notify()
+
+    def end_block(self):
+        """Save the data into the file at the end of a block."""
+        self.save()
+
+    def to_dataframe(self):
+        """Return all the rows written so far as a DataFrame."""
+        return self.store.to_dataframe().infer_objects()
+
+    def save(self):
+        """Save the data into the file."""
+        self._write(self._snapshot())
+
+    def close(self):
+        """
+        Wait until the writer saves its pending rows, then save the data into
+        the file.
+        """
+        atexit.unregister(self.close)
+        if self._thread is not None and self._thread.is_alive():
+            with self._cond:
+                self._closing = True
+                self._cond.notify()
+            self._thread.join()
+
+        self.save()
+        self._check_error()
+
+    def _snapshot(self):
+        """
+        Return the rows and the marginal posteriors added so far. Rows are
+        never modified once added, so a view on the store and shallow copies
+        of the lists of marginals are enough.
+        """
+        margs = {name: (list(margs), list(self._grids[name]))
+                 for name, margs in self._margs.items()}
+        return self.store.data, margs
+
+    def _write(self, snapshot):
+        """Write a snapshot of the data into the file."""
+        data, margs = snapshot
+        with self._lock:
+            # Skip a snapshot older than the saved file, e.g., one taken by
+            # the writer before the end of a block.
+            if len(data) < self._n_saved:
+                return
+
+            df = pd.DataFrame({col: data[col] for col in self.columns},
+                              columns=self.columns).infer_objects()
+            if self.format == 'parquet':
+                df.to_parquet(str(self.path), index=False)
+                self._n_saved = len(data)
+                return
+
+            arrays = {'_columns': np.array(self.columns, dtype=str)}
+            for col in self.columns:
+                values = df[col].to_numpy()
+                if values.dtype == object:
+                    values = np.array(['' if pd.isnull(v) else str(v)
+                                       for v in values])
+                arrays[col] = values
+
+            for name, (margs_name, grids_name) in margs.items():
+                arrays['marg_' + name] = stack_rows(margs_name, np.float16)
+                arrays['grid_' + name] = stack_rows(grids_name, np.float64)
+
+            # Write into a temporary file first, so that the file is never
+            # left half-written.
+            path_tmp = self.path.with_name(self.path.name + '.tmp')
+            with path_tmp.open('wb') as f:
+                np.savez_compressed(f, **arrays)
+            os.replace(str(path_tmp), str(self.path))
+            self._n_saved = len(data)
+
+    def _run(self):
+        """Write the latest snapshot until the logger is closed."""
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closing:
+                    self._cond.wait()
+                snapshot, self._pending = self._pending, None
+            if snapshot is None:
+                break
+
+            try:
+                self._write(snapshot)
+            except Exception as e:
+                self._error = e
+
+    def _check_error(self):
+        """Raise an error that occurred on the writer thread, if any."""
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _append_marginals(self, marginals, grids):
+        """Add the marginal posteriors of the last row."""
+        n = len(self.store)
+        for name in set(self._margs) | set(marginals or {}):
+            # Fill rows without marginals with None, to be saved as NaN.
+            margs = self._margs.setdefault(name, [])
+            grids_name = self._grids.setdefault(name, [])
+            margs.extend([None] * (n - 1 - len(margs)))
+            grids_name.extend([None] * (n - 1 - len(grids_name)))
+
+            if marginals is not None and name in marginals:
+                margs.append(np.asarray(marginals[name], dtype=np.float16))
+                grids_name.append(np.asarray(grids[name]))
+            else:
+                margs.append(None)
+                grids_name.append(None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def stack_rows(rows, dtype):
+    """
+    Stack 1-D arrays into a 2-D array of the given dtype, filling NaN for
+    rows given as None.
+    """
+    n_col = max([len(r) for r in rows if r is not None] + [0])
+    ret = np.full((len(rows), n_col), np.nan, dtype=dtype)
+    for i, r in enumerate(rows):
+        if r is not None:
+            ret[i] = r
+    return ret
+
+
+def read_session(path):
+    """
+    Read trial-by-trial data saved by `ColumnarTrialLogger` (or a CSV file
+    saved by `TrialLogger`). Returns a DataFrame of the trials, and
+    a dictionary of `(grid, marginals)` for each parameter whose marginal
+    posteriors are saved; rows of trials without marginals are NaN.
+    """
+    path = Path(path)
+
+    if path.suffix == '.csv':
+        return pd.read_csv(str(path)), {}
+    if path.suffix == '.parquet':
+        return pd.read_parquet(str(path)), {}
+
+    with np.load(str(path)) as f:
+        columns = list(f['_columns'])
+        df = pd.DataFrame({col: f[col] for col in columns}, columns=columns)
+        margs = {
+            key[len('marg_'):]: (f['grid_' + key[len('marg_'):]], f[key])
+            for key in f.files if key.startswith('marg_')
+        }
+    return df, margs
+
+
+###############################################################################
+# Posterior checkpoints
+###############################################################################
+
+
+class PosteriorCheckpoint(object):
+    """
+    Checkpoints of the log posterior of an ADOpy engine, kept in a ring of
+    slots in a preallocated memory-mapped `.npy` file. Each slot holds the
+    number of trials done, followed by the log posterior after those trials.
+    Since a checkpoint overwrites only the oldest slot, the file always has
+    a complete checkpoint even if the task crashes while saving one.
+
+    The checkpoints are only valid for the grids of the engine that saved
+    them; they do not support engines that refine their parameter grid.
+
+    Parameters
+    ----------
+    path : Path
+        Path to the checkpoint file.
+    n_param : int
+        Number of points on the parameter grid of the engine.
+    size : int, optional
+        Number of slots in the ring.
+    resume : bool, optional
+        If True, open the existing file to resume a session. Otherwise,
+        create a new file, overwriting an existing one.
+    """
+
+    def __init__(self, path, n_param, size=4, resume=False):
+        self.path = Path(path)
+
+        if resume:
+            self._mm = np.load(str(self.path), mmap_mode='r+')
+            if self._mm.shape[1] != n_param + 1:
+                raise ValueError('Checkpoints in {} do not match the grid '
+                                 'of the engine.'.format(self.path))
+        else:
+            self._mm = np.lib.format.open_memmap(
+                str(self.path), mode='w+', dtype=np.float64,
+                shape=(size, n_param + 1))
+            self._mm[:, 0] = -1  # Mark all slots as empty
+            self._mm.flush()
+
+    @property
+    def size(self):
+        """Number of slots in the ring."""
+        return self._mm.shape[0]
+
+    def save(self, n_done, log_post):
+        """Save the log posterior after `n_done` trials."""
+        slot = self._mm[n_done % self.size]
+
+        # Mark the slot as empty while writing, so a half-written slot is
+        # never loaded.
+        slot[0] = -1
+        slot[1:] = log_post
+        slot[0] = n_done
+        self._mm.flush()
+
+    def load(self, n_max=None):
+        """
+        Return the number of trials done and the log posterior of the last
+        checkpoint, or `(0, None)` if there is no checkpoint.
+
+        With `n_max`, e.g., the number of trials saved in the output file,
+        return the last checkpoint after at most `n_max` trials, so that the
+        checkpoint never counts trials whose rows were lost in a crash.
+        """
+        n_dones = self._mm[:, 0]
+        if n_max is not None:
+            n_dones = np.where(n_dones <= n_max, n_dones, -1)
+        i = int(np.argmax(n_dones))
+        n_done = int(n_dones[i])
+        if n_done < 0:
+            return 0, None
+        return n_done, np.array(self._mm[i, 1:])
+
+    def truncate(self, n_done):
+        """
+        Mark the checkpoints after more than `n_done` trials as empty, e.g.,
+        when resuming a session after `n_done` trials. Those checkpoints
+        were saved by the crashed run for trials whose rows were lost, and
+        would otherwise be loaded for the different trials of the resumed
+        run.
+        """
+        self._mm[self._mm[:, 0] > n_done, 0] = -1
+        self._mm.flush()
+
+    def close(self):
+        """Flush and close the checkpoint file."""
+        if self._mm is not None:
+            self._mm.flush()
+            self._mm = None
+
+
+###############################################################################
+# Posterior history
+###############################################################################
+
+
+class PosteriorHistory(object):
+    """
+    The posterior after each trial, compressed into keyframes and sparse
+    deltas. Every `keyframe_every` trials, the posterior is kept as
+    a keyframe of its entries above `tol`; on the other trials, only the
+    entries of the difference from the previous posterior whose magnitude is
+    above `tol` are kept. Each delta is taken from the posterior as it will
+    be reconstructed, not from the exact one, so the errors of dropped
+    entries do not accumulate: every reconstructed entry is within `tol` of
+    the exact posterior, up to the precision of `dtype`.
+
+    With `max_bytes`, the oldest keyframes and their deltas are dropped when
+    the history takes more memory than that; the posteriors of the dropped
+    trials are no longer available.
+
+    Parameters
+    ----------
+    n_param : int
+        Number of points on the parameter grid.
+    keyframe_every : int, optional
+        Number of trials between keyframes. Accessing a trial takes up to
+        this number of sparse additions.
+    tol : float, optional
+        Tolerance of entries to drop, in probability.
+    dtype : dtype, optional
+        Data type to keep the values of keyframes and deltas.
+    max_bytes : int, optional
+        Cap on the memory for the keyframes and deltas.
+    start : int, optional
+        Index of the first trial, e.g., the number of trials done before
+        a session was resumed.
+    """
+
+    def __init__(self, n_param, keyframe_every=20, tol=1e-8,
+                 dtype=np.float32, max_bytes=None, start=0):
+        self.n_param = n_param
+        self.keyframe_every = keyframe_every
+        self.tol = tol
+        self.dtype = np.dtype(dtype)
+        self.max_bytes = max_bytes
+        self.start = start
+        self.nbytes = 0
+
+        # Frames (indices and values) of each segment, which starts with
+        # a keyframe followed by deltas.
+        self._idx_dtype = np.min_scalar_type(max(n_param - 1, 0))
+        self._segments = []
+        self._n = start
+        self._last = None
+
+    def __len__(self):
+        """Number of trials in the history, including dropped ones."""
+        return self._n
+
+    @property
+    def first(self):
+        """Index of the first trial whose posterior is available."""
+        return self._segments[0][0] if self._segments else self._n
+
+    def append(self, post):
+        """Add the (normalised) posterior after the next trial."""
+        post = np.asarray(post, dtype=np.float64).ravel()
+
+        is_key = self._last is None or \
+            (self._n - self.start) % self.keyframe_every == 0
+        if is_key:
+            recon = np.zeros(self.n_param)
+            diff = post
+        else:
+            recon = self._last.copy()
+            diff = post - recon
+
+        idx = np.flatnonzero(np.abs(diff) > self.tol).astype(self._idx_dtype)
+        val = diff[idx].astype(self.dtype)
+        recon[idx] += val
+
+        if is_key:
+            self._segments.append((self._n, []))
+        self._segments[-1][1].append((idx, val))
+        self.nbytes += idx.nbytes + val.nbytes
+        self._last = recon
+        self._n += 1
+
+        # Drop the oldest segments over the cap on memory, but always keep
+        # the current one.
+        while self.max_bytes is not None and self.nbytes > self.max_bytes \
+                and len(self._segments) > 1:
+            _, frames = self._segments.pop(0)
+            self.nbytes -= sum(i.nbytes + v.nbytes for i, v in frames)
+
+    def __getitem__(self, trial):
+        """Return the posterior after the given trial."""
+        if trial < 0:
+            trial += self._n
+        if not self.first <= trial < self._n:
+            raise IndexError('The posterior after trial {} is not available.'
+                             .format(trial))
+
+        # Find the segment of the trial.
+        starts = [seg[0] for seg in self._segments]
+        start, frames = self._segments[np.searchsorted(starts, trial,
+                                                       side='right') - 1]
+
+        post = np.zeros(self.n_param)
+        for idx, val in frames[:trial - start + 1]:
+            post[idx] += val
+        return post
+
+    def save(self, path):
+        """Save the history into a `.npz` file."""
+        frames = [f for _, seg in self._segments for f in seg]
+        sizes = [len(idx) for idx, _ in frames]
+        np.savez(
+            str(path),
+            params=np.array([self.n_param, self.keyframe_every, self.start,
+                             self.first, self._n]),
+            tol=self.tol,
+            ptr=np.cumsum([0] + sizes),
+            idx=np.concatenate([idx for idx, _ in frames] +
+                               [np.empty(0, self._idx_dtype)]),
+            val=np.concatenate([val for _, val in frames] +
+                               [np.empty(0, self.dtype)]))
+
+    @classmethod
+    def load(cls, path):
+        """Load a history saved by `save`."""
+        with np.load(str(path)) as f:
+            n_param, keyframe_every, start, first, n = f['params'].tolist()
+            history = cls(n_param, keyframe_every, tol=float(f['tol']),
+                          dtype=f['val'].dtype, start=start)
+            ptr, idx, val = f['ptr'], f['idx'], f['val']
+
+        for i, trial in enumerate(range(first, n)):
+            frame = (idx[ptr[i]:ptr[i + 1]], val[ptr[i]:ptr[i + 1]])
+            if (trial - start) % keyframe_every == 0:
+                history._segments.append((trial, []))
+            history._segments[-1][1].append(frame)
+            history.nbytes += frame[0].nbytes + frame[1].nbytes
+        history._n = n
+        if n > first:
+            history._last = history[n - 1]
+        return history